@@ -1,14 +1,21 @@
+import re
 from . import config
 
 class Packet:
+    ESCAPE = re.compile(rb'[\x00-\x1f]')
     def __init__( self, data = {} ):
         self.__data = data
     def __call__( self ):
         return b'\0---\0' + b'\0'.join([self.__encode(key) + b'=' + self.__encode(self.__data[key]) for key in sorted(self.__data)]) + b'\0+++\0'
     def __encode( self, data ):
-        if not isinstance(data, bytes):
+        """
+            Value is str, bytes-like object (eg. memoryview) or tuple of them which are concatenated.
+        """
+        if isinstance(data, tuple):
+            return b''.join([self.__encode(x) for x in data])
+        if isinstance(data, str):
             data = data.encode(config.encoding)
-        return b''.join([bytes([x]) if x >= 0x20 else bytes([0x18, x ^ 0x40]) for x in data])
+        return Packet.ESCAPE.sub(lambda x: bytes([0x18, x.group()[0] ^ 0x40]), data)
 
 class PacketParser:
     def __init__( self, binary = False ):
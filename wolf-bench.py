@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import argparse, json, os, random, resource, shutil, struct, sys, tempfile, time
+
+from wolf import core, data, eventlog
+
+parser = argparse.ArgumentParser(description="Arctic Wolf: synthetic data generator and benchmarks of storage and replay.")
+commands = parser.add_subparsers(dest='command', required=True)
+
+generate = commands.add_parser('generate', help='Generate synthetic event log and binary storage.')
+generate.add_argument('--format', '-f', action='store', dest='format', choices=sorted(eventlog.formats), default='text', help='Format of event log (default: text).')
+generate.add_argument('--compression', action='store', dest='compression', choices=data.Data.COMPRESSION, default='none', help='Compression of content (default: none).')
+generate.add_argument('--problems', action='store', dest='problems', type=int, default=10, help='Number of problems (default: 10).')
+generate.add_argument('--tests', action='store', dest='tests', type=int, default=50, help='Number of tests in each problem (default: 50).')
+generate.add_argument('--teams', action='store', dest='teams', type=int, default=100, help='Number of teams (default: 100).')
+generate.add_argument('--submits', action='store', dest='submits', type=int, default=10000, help='Number of submits (default: 10000).')
+generate.add_argument('--verdicts', action='store', dest='verdicts', default='AC=0.4,WA=0.3,TL=0.1,RT=0.1,CE=0.1', help='Distribution of submit results (default: AC=0.4,WA=0.3,TL=0.1,RT=0.1,CE=0.1).')
+generate.add_argument('--test-size', action='store', dest='test_size', type=int, default=4096, help='Size of each test and answer in bytes (default: 4096).')
+generate.add_argument('--source-size', action='store', dest='source_size', type=int, default=1024, help='Size of each source and binary in bytes (default: 1024).')
+generate.add_argument('--archive', action='store_true', dest='archive', help='Add problems to archive and make submits as archive submits of teams.')
+generate.add_argument('--seed', action='store', dest='seed', type=int, default=0, help='Seed of random generator (default: 0).')
+generate.add_argument('data', metavar='<data>', help='Prefix for data files, they must not exist.')
+
+run = commands.add_parser('run', help='Measure replay of existing data and latency of appending new events.')
+run.add_argument('--workers', action='store', dest='workers', type=int, default=None, help='Number of processes which parse event log (default: number of CPUs).')
+run.add_argument('--appends', action='store', dest='appends', type=int, default=10000, help='Number of events appended in latency benchmark, 0 to skip it (default: 10000).')
+run.add_argument('--blob-size', action='store', dest='blob_size', type=int, default=4096, help='Size of content saved in latency benchmark (default: 4096).')
+run.add_argument('--format', '-f', action='store', dest='format', choices=sorted(eventlog.formats), default='text', help='Format of event log in latency benchmark (default: text).')
+run.add_argument('--durability', action='store', dest='durability', choices=data.Data.DURABILITY, default='flush', help='Durability of appends in latency benchmark (default: flush).')
+run.add_argument('--output', '-o', action='store', dest='output', default=None, help='File to write results to (default: stdout).')
+run.add_argument('data', metavar='<data>', help='Prefix for data files.')
+
+args = parser.parse_args()
+
+shedulers = {
+    'checker_compile': lambda id: None,
+    'solution_compile': lambda id: None,
+    'solution_test': lambda id, test: None
+}
+
+def open_data( prefix, replayers, **options ):
+    """
+        Data which replays its log into a fresh Wolf, all replayers are passed through replayers().
+    """
+    state = {}
+    def replay_wolf( timestamp, parameters ):
+        state['wolf'] = core.Wolf(timestamp, shedulers, storage)
+        storage.replayers = replayers(state['wolf'].replayers())
+    storage = data.Data(replayers({'wolf': replay_wolf}), prefix + '.bin', prefix + '.log', externals={'shedulers': shedulers}, **options)
+    return storage, state
+
+def text( random, size ):
+    """
+        Random compressible content looking like a test: lines of numbers.
+    """
+    lines, length = [], 0
+    while length < size:
+        lines.append(' '.join(str(random.randrange(10 ** 9)) for i in range(8)))
+        length += len(lines[-1]) + 1
+    return ('\n'.join(lines) + '\n').encode('ascii')[:size]
+
+def do_generate():
+    if os.path.exists(args.data + '.log') or os.path.exists(args.data + '.bin'):
+        sys.exit("data files %s.* already exist" % args.data)
+    verdicts = [(name, float(weight)) for name, weight in (x.split('=') for x in args.verdicts.split(','))]
+    rng = random.Random(args.seed)
+    start = time.time()
+    open(args.data + '.log', 'wb').close()
+    storage, state = open_data(args.data, lambda x: x, format=args.format, compression=args.compression)
+    storage.start()
+    storage.create('wolf', [])
+    storage.create('compiler.add', ['c', '${name%.c}.exe', 'gcc -O2 -o $binary $name', None])
+    storage.create('compiler.add', ['checker', '${name%.cpp}.exe', 'g++ -O2 -o $binary $name', None])
+    teams = ['team%04d' % x for x in range(args.teams)]
+    for team in teams:
+        storage.create('team.add', [team, 'Team %s' % team, 'password'])
+    for problem in range(args.problems):
+        storage.create('problem.create', [problem, chr(ord('a') + problem % 26), 'Problem #%d' % problem])
+        storage.create('problem.files.set', [problem, 'input.txt', 'output.txt'])
+        storage.create('problem.limits.set', [problem, 2.0, 268435456])
+        checker = storage.save(text(rng, args.source_size), 'check.cpp')
+        storage.create('problem.checker.set', [problem, checker, 'checker'])
+        binary = storage.save(bytes(rng.randrange(256) for i in range(args.source_size)), 'check.exe')
+        storage.create('problem.checker.compiled', [problem, binary, storage.save(b'')])
+        for test in range(args.tests):
+            storage.create('problem.test.add', [problem, storage.save(text(rng, args.test_size)), storage.save(text(rng, args.test_size))])
+        if args.archive:
+            storage.create('archive.add', [problem])
+        storage.commit()
+    for submit in range(args.submits):
+        problem = rng.randrange(args.problems)
+        source = storage.save(text(rng, args.source_size), 'solution.c')
+        if args.archive:
+            storage.create('archive.submit', [submit, rng.choice(teams), problem, source, 'c'])
+        else:
+            storage.create('submit', [submit, problem, source, 'c'])
+        verdict = rng.choices([x for x, y in verdicts], [y for x, y in verdicts])[0]
+        if verdict == 'CE':
+            storage.create('submit.compiled', [submit, '', storage.save(b'error: expected \';\'')])
+        else:
+            binary = storage.save(bytes(rng.randrange(256) for i in range(args.source_size)), 'solution.exe')
+            storage.create('submit.compiled', [submit, binary, storage.save(b'')])
+            last = args.tests if verdict == 'AC' else rng.randrange(args.tests) + 1
+            for test in range(last):
+                status = verdict if test == last - 1 and verdict != 'AC' else 'OK'
+                storage.create('submit.test', [submit, test, status, round(rng.random(), 3), rng.randrange(1 << 20, 1 << 26)])
+        storage.commit()
+    print("generated %s: %d problems, %d teams, %d submits in %.2f seconds" % (args.data, args.problems, args.teams, args.submits, time.time() - start))
+
+def percentiles( values ):
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {('p%g' % (100 * p)).replace('.', '_'): values[min(len(values) - 1, int(p * len(values)))] for p in (0.5, 0.9, 0.99, 0.999)}
+    return dict(result, max=values[-1], mean=sum(values) / len(values))
+
+def do_run():
+    result = {'data': args.data}
+
+    # replay: whole log is replayed into Wolf, replayers are timed by event type
+    events = {}
+    def timed( replayers ):
+        def wrap( name, replayer ):
+            counters = events.setdefault(name, {'count': 0, 'seconds': 0.0})
+            def call( timestamp, parameters ):
+                start = time.perf_counter()
+                replayer(timestamp, parameters)
+                counters['seconds'] += time.perf_counter() - start
+                counters['count'] += 1
+            return call
+        return {name: wrap(name, replayer) for name, replayer in replayers.items()}
+    storage, state = open_data(args.data, timed, workers=args.workers)
+    start = time.perf_counter()
+    storage.start()
+    duration = time.perf_counter() - start
+    count = sum(x['count'] for x in events.values())
+    segments = storage.segments()
+    result['replay'] = {
+        'seconds': duration, 'events': count, 'events_per_second': count / duration if duration > 0 else None,
+        'log_bytes': sum(x[2] for x in segments['log']), 'bin_bytes': sum(x[2] for x in segments['bin']),
+        'by_event': {name: dict(x, us_per_event=1e6 * x['seconds'] / x['count']) for name, x in sorted(events.items()) if x['count'] > 0},
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+    print("replayed %d events in %.2f seconds" % (count, duration), file=sys.stderr)
+
+    # append: latency of create + commit and of save + commit in a fresh temporary storage
+    if args.appends > 0:
+        directory = tempfile.mkdtemp(prefix='wolf-bench.')
+        try:
+            prefix = os.path.join(directory, 'data')
+            open(prefix + '.log', 'wb').close()
+            replayers = {'content': lambda timestamp, parameters: None, 'submit.test': lambda timestamp, parameters: None}
+            storage = data.Data(replayers, prefix + '.bin', prefix + '.log', format=args.format, durability=args.durability)
+            storage.start()
+            rng = random.Random(0)
+            create, save = [], []
+            for index in range(args.appends):
+                start = time.perf_counter()
+                storage.create('submit.test', [index, index % 50, 'OK', 0.123, 12345678])
+                storage.commit()
+                create.append(time.perf_counter() - start)
+            blob = bytearray(text(rng, max(args.blob_size, 8)))
+            for index in range(args.appends):
+                blob[:8] = struct.pack('<Q', index) # every blob is new, so dedup doesn't skip writing
+                start = time.perf_counter()
+                storage.save(bytes(blob))
+                storage.commit()
+                save.append(time.perf_counter() - start)
+            result['append'] = {
+                'format': args.format, 'durability': args.durability, 'events': args.appends, 'blob_size': args.blob_size,
+                'create_seconds': percentiles(create), 'save_seconds': percentiles(save),
+                'commit': storage.stats()
+            }
+        finally:
+            shutil.rmtree(directory)
+    result['peak_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    output = json.dumps(result, indent=1, sort_keys=True) + '\n'
+    if args.output is None:
+        sys.stdout.write(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+{'generate': do_generate, 'run': do_run}[args.command]()
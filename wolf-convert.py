@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import argparse, sys, time
+
+from wolf import eventlog
+
+parser = argparse.ArgumentParser(description="Arctic Wolf: convert event log between text and binary formats.")
+parser.add_argument('--format', '-f', action='store', dest='format', choices=sorted(eventlog.formats), help='Format of output log (default: the other one).')
+parser.add_argument('--no-verify', action='store_false', dest='verify', help='Do not read output back and compare it with input.')
+parser.add_argument('input', metavar='<input>', help='Event log to convert.')
+parser.add_argument('output', metavar='<output>', help='Where to write converted log, must not exist.')
+args = parser.parse_args()
+
+def records( path ):
+    with open(path, 'rb') as f:
+        format = eventlog.detect(f.read(len(eventlog.BinaryFormat.MAGIC)), 'text')
+        f.seek(len(format.header))
+        yield format
+        yield from format.records(f)
+
+start = time.time()
+source = records(args.input)
+source_format = next(source)
+target_format = eventlog.formats[args.format] if args.format is not None else \
+    eventlog.formats['binary' if source_format.name == 'text' else 'text']
+print("converting %s (%s) → %s (%s)" % (args.input, source_format.name, args.output, target_format.name))
+
+count = 0
+with open(args.output, 'xb') as f:
+    f.write(target_format.header)
+    for timestamp, event, parameters in source:
+        f.write(target_format.encode(timestamp, event, parameters))
+        count += 1
+    size = f.tell()
+print("%d events, %d bytes written in %.2f seconds" % (count, size, time.time() - start))
+
+if args.verify:
+    text = lambda record: (record[0], record[1], [None if x is None else str(x) for x in record[2]])
+    source, target = records(args.input), records(args.output)
+    next(source), next(target)
+    for index, (x, y) in enumerate(zip(source, target)):
+        if text(x) != text(y):
+            print("verification failed at event #%d:\n  %s\n  %s" % (index, str(x), str(y)))
+            sys.exit(1)
+    if next(source, None) is not None or next(target, None) is not None:
+        print("verification failed: different number of events")
+        sys.exit(1)
+    print("verified, output log is equivalent to input")
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
-import argparse, base64, io, json, select, socket, struct, sys
+import argparse, base64, collections, io, json, os, select, socket, struct, sys, time
 
 from dts.protocol import Packet, PacketParser
 from wolf import core, data, network
+from wolf.data import Data
 from wolf.common import log
 from wolf.queue import Queue
 from wolf.judge import Judge
+from wolf.judgequeue import JudgeQueue
 from wolf.magic import magic_parse
 
 log.write(" === ARCTIC WOLF ===")
@@ -14,8 +16,22 @@ log.write(" === ARCTIC WOLF ===")
 parser = argparse.ArgumentParser(description="Arctic Wolf: contest management system.")
 parser.add_argument('--port', '-p', action='store', dest='port', required=True, help='Default port to listen.')
 parser.add_argument('--judge-port', action='store', dest='judge_port', default=17239, help='Port to listen connections from judges (default: 17239).')
+parser.add_argument('--judge-timeout', action='store', dest='judge_timeout', type=float, default=60.0, help='Seconds judge has for compilation, testing gets also twice the time limit of problem; work of late judge goes to another one (default: 60).')
+parser.add_argument('--judge-timeouts', action='store', dest='judge_timeouts', type=int, default=3, help='Disconnect judge after this number of late answers in a row (default: 3).')
+parser.add_argument('--judge-slots', action='store', dest='judge_slots', type=int, default=1, help='Number of requests each judge works on at once, unless judge declares it (default: 1).')
+parser.add_argument('--rejudge-batch', action='store', dest='rejudge_batch', type=int, default=20, help='Number of submits of each contest which are rejudged at once, the rest of rejudge waits, so live judging goes on (default: 20).')
 parser.add_argument('-u', action='store', dest='unix', help='Unix socket for command console (not used by default).')
-parser.add_argument('data', metavar='<data>', help='Prefix for data files.')
+parser.add_argument('--log-format', action='store', dest='log_format', choices=['text', 'binary'], default='text', help='Format of new event log, existing log keeps its format (default: text).')
+parser.add_argument('--dedup', action='store', dest='dedup', choices=data.Data.DEDUP, default='md5', help='How to detect content which is already stored: by md5, by md5 and sha256, or none (default: md5).')
+parser.add_argument('--durability', action='store', dest='durability', choices=data.Data.DURABILITY, default='flush', help='What to do with each batch of events: leave in buffers, flush to OS or fsync (default: flush).')
+parser.add_argument('--replay-workers', action='store', dest='replay_workers', type=int, default=None, help='Number of processes which parse event log on start (default: number of CPUs).')
+parser.add_argument('--snapshot-interval', action='store', dest='snapshot_interval', type=int, default=50000, help='Save state snapshot after this number of events, 0 to disable (default: 50000).')
+parser.add_argument('--segment-size', action='store', dest='segment_size', type=int, default=1 << 30, help='Size of event log and binary storage segments in bytes (default: 1 GiB).')
+parser.add_argument('--cache-size', action='store', dest='cache_size', type=int, default=1 << 26, help='Memory budget for decompressed tests and other content in bytes, 0 to disable (default: 64 MiB).')
+parser.add_argument('--compression', action='store', dest='compression', choices=data.Data.COMPRESSION, default='none', help='Codec for new big compressible content, stored content keeps its codec (default: none).')
+parser.add_argument('--replica', action='store_true', dest='replica', help='Follow data files written by another (primary) wolf.py and serve only read-only requests, judges are not accepted.')
+parser.add_argument('--follow-interval', action='store', dest='follow_interval', type=float, default=0.5, help='Seconds between checks of event log of the primary in replica mode (default: 0.5).')
+parser.add_argument('data', metavar='<data>', nargs='+', help='Prefix for data files, [<name>=]<prefix> for each contest; requests choose contest by name in "contest" field, default is the first one (name defaults to base name of prefix).')
 args = parser.parse_args()
 
 unix_id = 0
@@ -30,6 +46,35 @@ def cb_unix( peer, socket, init ):
         command = command[0]
         if command == 'help':
             socket.send(b'no help availible\n')
+        elif command == 'queue':
+            socket.send((json.dumps(judge_queue.stats(), sort_keys=True) + '\n').encode('utf8'))
+        elif command == 'judges':
+            socket.send((json.dumps([
+                dict(judge.stats(), name=judge.name(), free=free_judges.count(judge)) for judge in judges
+            ], sort_keys=True) + '\n').encode('utf8'))
+        elif args.replica and command in ('snapshot', 'compact'):
+            socket.send(b'replica is read-only\n')
+        elif command in ('snapshot', 'stats', 'compact'):
+            # contests are given as arguments, all contests by default
+            if any(x not in contests for x in arguments):
+                socket.send(('unknown contest: %s\n' % ' '.join(x for x in arguments if x not in contests)).encode('utf8'))
+                return
+            chosen = [contests[x] for x in arguments] if arguments else list(contests.values())
+            if command == 'snapshot':
+                for contest in chosen:
+                    contest.data.snapshot(contest.wolf)
+                socket.send(b'ok\n')
+            elif command == 'stats':
+                socket.send((json.dumps({
+                    contest.name: dict(
+                        {'data': contest.data.stats(), 'segments': contest.data.segments(), 'cache': contest.data.cache.stats()},
+                        **({'replication': contest.data.replication()} if args.replica else {})
+                    )
+                    for contest in chosen
+                }, sort_keys=True) + '\n').encode('utf8'))
+            else:
+                started = [contest.name for contest in chosen if contest.data.compact(contest.wolf.content_live(), within(contest, relocate))]
+                socket.send(('compaction started: %s\n' % ' '.join(started) if started else 'compaction is already running\n').encode('utf8'))
         else:
             socket.send(('unknown command: %s\n' % command).encode('utf8'))
     tail = b''
@@ -55,8 +100,15 @@ def cb_unix( peer, socket, init ):
 def cb_main( peer, socket, init ):
     global net_actions
     log("INFO: peer %s connected" % str(peer))
-    def result( data ):
-        socket.send((json.dumps(data) + '\n').encode("utf-8"))
+    def result( value ):
+        message = (json.dumps(value) + '\n').encode("utf-8")
+        def send():
+            try:
+                socket.send(message)
+            except OSError as error:
+                log("ERROR: cannot send reply to peer %s: %s" % (str(peer), str(error)))
+        # reply must not reach client before events it depends on are committed
+        data.after_commit(send)
         return []
     def handle_packet( data ):
         try:
@@ -66,6 +118,12 @@ def cb_main( peer, socket, init ):
             return result(False)
         if not isinstance(data, dict) or 'action' not in data:
             return result(False)
+        contest = contests.get(data.get('contest', default_contest))
+        if contest is None:
+            return result(False)
+        if args.replica and data['action'] not in readonly_actions:
+            return result(False)
+        switch(contest)
         return result(net_actions.get(data['action'], lambda data: False)(data))
         # False if data['action'] not in actions else actions[data['action']](data));
     tail = b''
@@ -88,14 +146,16 @@ def cb_main( peer, socket, init ):
 
 def cb_judge( peer, socket, init ):
     parser = PacketParser(binary=True)
-    judge = Judge(socket, judge_ready)
+    judge = Judge(socket, judge_ready, args.judge_slots)
+    judges.append(judge)
     def cb_data( data ):
+        if len(data) == 0:
+            return cb_halt()
         parser.add(data)
         return [(judge.receive, [x]) for x in parser()]
     def cb_halt():
         log("INFO: judge peer %s disconnected" % str(peer))
-        # todo: shutdown judge and restart its active actions
-        socket.disconnect()
+        judge_remove(judge)
         return []
     return init(cb_data, cb_halt)
 
@@ -112,11 +172,12 @@ s.bind(('127.0.0.1', int(args.port)))
 s.listen(100)
 poll.add_listener(s, cb_main)
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('II', 1, 0))
-s.bind(('', int(args.judge_port)))
-s.listen(100)
-poll.add_listener(s, cb_judge)
+if not args.replica:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('II', 1, 0))
+    s.bind(('', int(args.judge_port)))
+    s.listen(100)
+    poll.add_listener(s, cb_judge)
 
 
 def action_create( parameters, continuation, defaults = {} ):
@@ -167,9 +228,13 @@ def action_archive_submit( team, problem, name, source, compiler ):
     id = wolf.submit_count()
     data.create('archive.submit', [id, team, problem, source, compiler])
     return id
-def action_archive_submits( team, problem, start, limit ):
+def action_archive_submits( team, problem, start, limit, verdict, compiler, time_from, time_to, cursor ):
+    if start is None or verdict is not None or compiler is not None or time_from is not None or time_to is not None or cursor is not None:
+        return action_archive_submits_query(team, problem, verdict, compiler, time_from, time_to, cursor, limit)
     if not isinstance(start, int) or not isinstance(limit, int):
         return False
+    if not (team is None or isinstance(team, str)) or not (problem is None or isinstance(problem, int)):
+        return False
     archive = wolf.archive_get()
     if team is None and problem is None:
         submits = archive.submits_all
@@ -189,6 +254,25 @@ def action_archive_submits( team, problem, start, limit ):
         limit = len(submits) - start
     start = len(submits) - start - limit
     return {'count': len(submits), 'list': list(reversed(submits[start:start + limit]))}
+def action_archive_submits_query( team, problem, verdict, compiler, time_from, time_to, cursor, limit ):
+    """
+        Archive submits by any combination of filters, newest first, with summaries. Pages
+        are chained by cursor: 'next' of result is passed as cursor to get the next page.
+    """
+    number = lambda x: x is None or isinstance(x, (int, float)) and not isinstance(x, bool)
+    string = lambda x: x is None or isinstance(x, str)
+    if not isinstance(limit, int) or not 0 < limit <= 1000 or not all(number(x) for x in (time_from, time_to, cursor)):
+        return False
+    if not all(string(x) for x in (team, verdict, compiler)) or not (problem is None or isinstance(problem, int) and not isinstance(problem, bool)):
+        return False
+    submits, next = wolf.archive_submits(team, problem, verdict, compiler, time_from, time_to, cursor, limit)
+    summaries = []
+    for id in submits:
+        submit = wolf.submit_get(id)
+        summary = action_submit_info(id)
+        summary.update({'team': submit.origin[1], 'compiler': submit.compiler})
+        summaries.append(summary)
+    return {'list': summaries, 'next': next}
 
 def action_compiler_add( id, binary, compile, run ):
     if wolf.compiler_get(id) is not None:
@@ -253,7 +337,7 @@ def action_problem_info( id ):
         'name': problem.name, 'full': problem.full,
         'input': problem.input, 'output': problem.output,
         'time_limit': problem.time_limit, 'memory_limit': problem.memory_limit,
-        'tests': len(problem.tests)
+        'tests': len(problem.tests), 'parallel': problem.parallel, 'deterministic': problem.deterministic
     }
 def action_problem_files_set( id, input, output ):
     if wolf.problem_get(id) is None:
@@ -273,6 +357,21 @@ def action_problem_modify( id, name, full ):
         return False
     data.create("problem.modify", [id, name, full])
     return True
+def action_problem_deterministic_set( id, deterministic ):
+    if not isinstance(id, int) or not isinstance(deterministic, bool) or wolf.problem_get(id) is None:
+        return False
+    data.create("problem.deterministic.set", [id, int(deterministic)])
+    return True
+def action_problem_parallel_set( id, parallel ):
+    if not isinstance(id, int) or not isinstance(parallel, int) or parallel < 1 or wolf.problem_get(id) is None:
+        return False
+    data.create("problem.parallel.set", [id, parallel])
+    return True
+def action_problem_rejudge( id, verdict, time_from, time_to ):
+    if not isinstance(id, int) or wolf.problem_get(id) is None or not (verdict is None or isinstance(verdict, str)) or \
+            not all(x is None or isinstance(x, (int, float)) for x in (time_from, time_to)):
+        return False
+    return rejudge_start(wolf.submits_find(id, verdict, time_from, time_to))
 def action_problem_test_add( id, test, answer ):
     if id < 0 or id >= wolf.problem_count():
         return False
@@ -311,6 +410,11 @@ def action_submit_info( id ):
        data['result'] = result
        data['test'] = test
     return data
+def action_submit_rejudge( id ):
+    ids = id if isinstance(id, list) else [id]
+    if not all(isinstance(x, int) and wolf.submit_get(x) is not None for x in ids):
+        return False
+    return rejudge_start(ids)
 def action_submit_report( id ):
     if isinstance(id, list):
         return [action_submit_report(x) for x in id]
@@ -326,7 +430,7 @@ def action_submit_report( id ):
     else:
         compiler_output = b''
     if len(compiler_output) > 2048:
-        compiler_output = compiler_output[:2000] + b'...(truncated)\n'
+        compiler_output = bytes(compiler_output[:2000]) + b'...(truncated)\n'
     return {'compiler_output': base64.b64encode(compiler_output).decode('ascii')}
 def action_submit_source( id ):
     if isinstance(id, list):
@@ -347,6 +451,34 @@ def action_submit_source( id ):
 #    status, test = submit.result if submit.result is not None else (None, None)
 #    return {'status': status, 'test': test}
 
+def action_rejudge_cancel( job ):
+    job = current.rejudges.get(job)
+    if job is None:
+        return False
+    job.cancel()
+    return job.status()
+def action_rejudge_list():
+    return [job.status() for job in current.rejudges.values()]
+def action_rejudge_status( job ):
+    if isinstance(job, list):
+        return [action_rejudge_status(x) for x in job]
+    job = current.rejudges.get(job)
+    return job.status() if job is not None else False
+
+def action_replication():
+    return data.replication() if args.replica else False
+
+def action_standings( start, limit ):
+    if not isinstance(start, int) or not (limit is None or isinstance(limit, int)) or start < 0 or limit is not None and limit < 0:
+        return False
+    standings = wolf.standings_get()
+    return {'sequence': standings.sequence, 'count': len(standings), 'rows': standings.rows(start, limit)}
+def action_standings_since( sequence ):
+    if not isinstance(sequence, int):
+        return False
+    standings = wolf.standings_get()
+    return {'sequence': standings.sequence, 'count': len(standings), 'rows': standings.since(sequence)}
+
 def action_team_add( login, name, password ):
     if wolf.team_get(login) is not None:
         return False
@@ -378,7 +510,10 @@ net_actions = {
     'archive.list': action_create(['start', 'limit'], action_archive_list),
     'archive.remove': action_create(['id'], action_archive_remove),
     'archive.submit': action_create(['team', 'problem', 'name', 'source', 'compiler'], action_archive_submit),
-    'archive.submits': action_create(['team', 'problem', 'start', 'limit'], action_archive_submits, defaults = {'team': None, 'problem': None}),
+    'archive.submits': action_create(
+        ['team', 'problem', 'start', 'limit', 'verdict', 'compiler', 'time_from', 'time_to', 'cursor'], action_archive_submits,
+        defaults = {'team': None, 'problem': None, 'start': None, 'limit': 20, 'verdict': None, 'compiler': None, 'time_from': None, 'time_to': None, 'cursor': None}
+    ),
     'compiler.add': action_create(['id', 'binary', 'compile', 'run'], action_compiler_add),
     'compiler.info': action_create(['id'], action_compiler_info),
     'compiler.list': action_create([], action_compiler_list),
@@ -389,18 +524,31 @@ net_actions = {
     'problem.checker.set': action_create(["id", "name", "source", "compiler"], action_problem_checker_set),
     'problem.checker.source': action_create(["id"], action_problem_checker_source),
     'problem.create': action_create(['name', 'full'], action_problem_create),
+    'problem.deterministic.set': action_create(['id', 'deterministic'], action_problem_deterministic_set),
     'problem.info': action_create(['id'], action_problem_info),
     'problem.files.set': action_create(['id', 'input', 'output'], action_problem_files_set),
     'problem.limits.set': action_create(['id', 'time', 'memory'], action_problem_limits_set),
     'problem.modify': action_create(['id', 'name', 'full'], action_problem_modify),
+    'problem.parallel.set': action_create(['id', 'parallel'], action_problem_parallel_set),
+    'problem.rejudge': action_create(
+        ['id', 'verdict', 'time_from', 'time_to'], action_problem_rejudge,
+        defaults = {'verdict': None, 'time_from': None, 'time_to': None}
+    ),
     'problem.test.add': action_create(['id', 'test', 'answer'], action_problem_test_add),
     'problem.test.count': action_create(['id'], action_problem_test_count),
     #'problem.test.insert':
     #'problem.test.remove':
+    'rejudge.cancel': action_create(['job'], action_rejudge_cancel),
+    'rejudge.list': action_create([], action_rejudge_list),
+    'rejudge.status': action_create(['job'], action_rejudge_status),
+    'replication': action_create([], action_replication),
     'submit': action_create(['problem', 'name', 'source', 'compiler'], action_submit),
     'submit.info': action_create(['id'], action_submit_info),
+    'submit.rejudge': action_create(['id'], action_submit_rejudge),
     'submit.report': action_create(['id'], action_submit_report),
     'submit.source': action_create(['id'], action_submit_source),
+    'standings': action_create(['start', 'limit'], action_standings, defaults = {'start': 0, 'limit': None}),
+    'standings.since': action_create(['sequence'], action_standings_since),
     # removed: 'submit.status': action_create(['id'], action_submit_status),
     'team.add': action_create(['login', 'name', 'password'], action_team_add),
     'team.info': action_create(['login'], action_team_info),
@@ -408,15 +556,70 @@ net_actions = {
     'team.modify': action_create(['login', 'name', 'password'], action_team_modify, defaults = {'password': None})
 }
 
+# actions which don't create events, replica serves only them
+readonly_actions = {
+    'archive.compiler.list', 'archive.count', 'archive.list', 'archive.submits',
+    'compiler.info', 'compiler.list',
+    'problem.checker.source', 'problem.info', 'problem.test.count',
+    'replication',
+    'standings', 'standings.since',
+    'submit.info', 'submit.report', 'submit.source',
+    'team.info', 'team.login'
+}
+
 def problem_add( message ):
     log("ERROR: %s" % message)
     problems.push(message)
 
 def judge_ready( judge ):
     result = [] if free_judges or not judge_queue else [(judge_check_queue, ())]
-    free_judges.push(judge)
+    free_judges.append(judge)
     return result
 
+def judge_get( hashes=() ):
+    """
+        Take a free judge, preferring one which holds most of given files, or None.
+    """
+    if not free_judges:
+        return None
+    # the first judge is the one which waits longest, it wins ties
+    best = max(range(len(free_judges)), key=lambda x: (free_judges[x].holds(hashes), -x))
+    return free_judges.pop(best)
+
+def judge_remove( judge ):
+    """
+        Disconnect judge and give its work to other judges.
+    """
+    if judge in judges:
+        judges.remove(judge)
+    free_judges[:] = [x for x in free_judges if x is not judge]
+    judge_retry(judge.shutdown())
+
+def judge_retry( retries ):
+    for retry in retries:
+        if retry is not None:
+            actions.push(retry)
+
+def judge_check_deadlines():
+    for judge in list(judges):
+        judge_retry(judge.expire())
+        if judge.timeouts >= args.judge_timeouts:
+            log("ERROR: judge %s is late %d times in a row, disconnecting it" % (judge.name(), judge.timeouts))
+            judge_remove(judge)
+
+def submit_priority( id, stage ):
+    """
+        Return class and owner of work on submit in judge queue: rejudged and archive submits
+        wait for live ones, teams take turns inside a class.
+    """
+    submit = wolf.submit_get(id)
+    team = submit.origin[1] if submit.origin is not None else None
+    if submit.origin is not None:
+        return 'archive', (current.name, team)
+    if any(id in job.running for job in current.rejudges.values()):
+        return 'rejudge', (current.name, team)
+    return stage, (current.name, team)
+
 def judge_check_queue():
     while free_judges and judge_queue:
         action, parameters = judge_queue.pop()
@@ -437,10 +640,15 @@ def action_checker_compile( id ):
     if compiler.binary is None and compiler.compile is None:
         # interpretator, no need for compile
         checker.binary = checker.source
-        return
+        return checker_ready(id)
+    compiled = wolf.compiled_get(checker.source, checker.compiler)
+    if compiled is not None:
+        log("checker for problem #%d is compiled already" % id)
+        data.create("problem.checker.compiled", [id] + list(compiled))
+        return checker_ready(id)
     judge = judge_get()
     if judge is None:
-        judge_queue.push((action_checker_compile, (id,)))
+        judge_queue.push((within(current, action_checker_compile), (id,)), 'checker', current.name)
         return
     problem.checker.binary = False
     source = wolf.content_get(checker.source)
@@ -453,20 +661,36 @@ def action_checker_compile( id ):
             binary = data.save(binary, binary_name)
             output = data.save(output)
             data.create("problem.checker.compiled", [id, binary, output])
+            checker_ready(id)
             return []
         else:
             log("failed to compile checker for problem #%d:\n%s" % (id, output.decode('iso8859-1')))
             return []
-    judge.compile(command, source, binary_name, callback)
+    def retry():
+        if problem.checker is checker and checker.binary is False:
+            checker.binary = None
+            action_checker_compile(id)
+    judge.compile(command, source, binary_name, within(current, callback), (within(current, retry), ()), args.judge_timeout)
+
+def checker_ready( id ):
+    """
+        Compile submits which waited for checker of problem.
+    """
+    for submit in sorted(current.waiting.pop(id, ())):
+        actions.push((within(current, action_submit_compile), (submit,)))
 
 def action_submit_compile( id ):
     submit = wolf.submit_get(id)
     if submit.binary is not None:
         return
     problem = wolf.problem_get(submit.problem)
-    if problem is None or problem.checker is None or problem.checker.binary is None:
-        # todo: move submit into queue if problem is not ready
-        return problem_add("failed to test submit #%d: problem #%d doesn't exists or isn't ready" % (id, submit.problem))
+    if problem is None:
+        return problem_add("failed to test submit #%d: problem #%d doesn't exist" % (id, submit.problem))
+    if problem.checker is None or not isinstance(problem.checker.binary, str):
+        # compiled by checker_ready, when checker is set and compiled
+        log("submit #%d waits for checker of problem #%d" % (id, submit.problem))
+        current.waiting.setdefault(submit.problem, set()).add(id)
+        return
     compiler = wolf.compiler_get(submit.compiler)
     if compiler is None:
         return problem_add("failed to compile submit #%d: compiler not exists: %s" % (id, submit.compiler))
@@ -476,14 +700,22 @@ def action_submit_compile( id ):
         submit.compiler_output = None
         wolf.force_submit_test(id)
         return
+    compiled = wolf.compiled_get(submit.source, submit.compiler)
+    if compiled is not None:
+        log("submit #%d is compiled already" % id)
+        data.create('submit.compiled', [id] + list(compiled))
+        return
     judge = judge_get()
     if judge is None:
-        judge_queue.push((action_submit_compile, (id,)))
+        judge_queue.push((within(current, action_submit_compile), (id,)), *submit_priority(id, 'compile'))
         return
     source = wolf.content_get(submit.source)
     binary_name = magic_parse(compiler.binary, {'name': source.name})
     command = magic_parse(compiler.compile, {'name': source.name, 'binary': binary_name})
     def callback( result, binary, output ):
+        if wolf.submit_get(id).binary is not None:
+            # compiled already, by another request for the same submit
+            return []
         if result is Judge.OK:
             log("submit #%d compiled, size = %d, output:\n%s" % (id, len(binary), output.decode('iso8859-1')))
             binary = data.save(binary, binary_name)
@@ -496,11 +728,23 @@ def action_submit_compile( id ):
         else:
             problem_add("failed to compile submit #%d" % id)
         return []
-    judge.compile(command, source, binary_name, callback)
+    judge.compile(command, source, binary_name, within(current, callback), (within(current, action_submit_compile), (id,)), args.judge_timeout)
+
+def testing_finished( id ):
+    """
+        Unpin tests of problem when the last of its submits which are being tested gets result.
+    """
+    submit = wolf.submit_get(id)
+    if submit.result is None or id not in testing.get(submit.problem, ()):
+        return
+    testing[submit.problem].discard(id)
+    if not testing[submit.problem]:
+        del testing[submit.problem]
+        data.cache.unpin(('problem', submit.problem))
 
 def action_submit_test( id, test_no ):
     submit = wolf.submit_get(id)
-    if submit.result is not None or submit.tests[test_no].status is not None:
+    if submit.result is not None or test_no not in submit.testings or submit.tests[test_no].status is not None:
         return
     assert 0 <= test_no < len(submit.tests)
     problem = wolf.problem_get(submit.problem)
@@ -512,15 +756,21 @@ def action_submit_test( id, test_no ):
         return problem_add("failed to compile submit #%d: compiler not exists: %s" % (id, submit.compiler))
     if checker_compiler is None:
         return problem_add("failed to compile submit #%d: compiler not exists: %s" % (id, checker.compiler))
-    judge = judge_get()
+    verdict = wolf.verdict_get(id, test_no)
+    if verdict is not None:
+        log("submit #%d result on test #%d: %s (the same run is tested already)" % (id, test_no, verdict[0]))
+        data.create('submit.test', [id, test_no] + list(verdict))
+        testing_finished(id)
+        return
+    test = submit.tests[test_no]
+    judge = judge_get((submit.binary, test.test, test.answer, checker.binary))
     if judge is None:
-        judge_queue.push((action_submit_test, (id, test_no)))
+        judge_queue.push((within(current, action_submit_test), (id, test_no)), *submit_priority(id, 'test'))
         return
     if submit_compiler.run is not None and submit_compiler.run == "$binary":
         log("WARNING: compiler %s has deprecated run string" % submit.compiler)
     if checker_compiler.run is not None and checker_compiler.run == "$binary":
         log("WARNING: compiler %s has deprecated run string" % checker.compiler)
-    test = submit.tests[test_no]
     submit_binary = wolf.content_get(submit.binary)
     submit_source = wolf.content_get(submit.source)
     checker_source = wolf.content_get(checker.source)
@@ -535,11 +785,23 @@ def action_submit_test( id, test_no ):
         checker_run = magic_parse(checker_compiler.run, {'name': checker_source.name, 'binary': checker_binary.name})
     data_test = wolf.content_get(test.test)
     data_answer = wolf.content_get(test.answer)
+    if id not in testing.setdefault(submit.problem, set()):
+        # tests of problem stay in cache while its solutions are being tested
+        testing[submit.problem].add(id)
+        data.cache.pin(('problem', submit.problem), wolf.content_tests(submit.problem))
+    round = submit.round
     def callback( status, maxtime, maxmemory, output ):
         log("submit #%d result on test #%d: %s" % (id, test_no, Judge.status_str[status]))
         if len(output) > 0:
             log(output.decode('iso8859-1'))
+        if wolf.submit_get(id).round != round:
+            # submit was rejudged meanwhile, answer is about the old binary or checker
+            return []
+        if test_no not in wolf.submit_get(id).testings:
+            # earlier test failed while this one was tested, result doesn't depend on it
+            return []
         data.create('submit.test', [id, test_no, Judge.status_str[status], maxtime, maxmemory])
+        testing_finished(id)
         return []
     # todo: use compiler 'run' command
     judge.test(
@@ -553,44 +815,198 @@ def action_submit_test( id, test_no ):
         memory_limit = problem.memory_limit,
         checker = checker_binary,
         checker_run = checker_run,
-        callback = callback
+        callback = within(current, callback),
+        retry = (within(current, action_submit_test), (id, test_no)),
+        timeout = args.judge_timeout + 2 * problem.time_limit
     )
 
-judge_get = lambda: free_judges.pop() if free_judges else None
-
-def replay_wolf( timestamp, parameters ):
-    global wolf, data
-    wolf = core.Wolf(timestamp, shedulers, data)
-    data.replayers = wolf.replayers()
-
-replayers = {
-    'wolf': replay_wolf
-}
-
-wolf = None
 
-free_judges = Queue()
-judge_queue = Queue()
+class Rejudge:
+    """
+        Rejudge of a list of submits. Submits are reset (by submit.rejudge event) a few at
+        once, see rejudge_feed, so live submits are judged meanwhile. Jobs are not stored:
+        submits which are reset already are judged after restart, the rest is forgotten.
+    """
+    def __init__( self, id, submits ):
+        self.id = id
+        self.pending = collections.deque(submits)
+        self.running = set()
+        self.total, self.done, self.skipped = len(self.pending), 0, 0
+        self.started, self.finished = time.time(), None
+        self.cancelled = False
+    def active( self ):
+        return self.finished is None
+    def cancel( self ):
+        """
+            Forget submits which are not reset yet, running ones get their results.
+        """
+        self.skipped += len(self.pending)
+        self.pending.clear()
+        self.cancelled = True
+    def status( self ):
+        return {
+            'job': self.id, 'total': self.total, 'done': self.done, 'skipped': self.skipped,
+            'running': len(self.running), 'pending': len(self.pending),
+            'state': 'cancelled' if self.cancelled else 'running' if self.active() else 'finished',
+            'started': self.started, 'finished': self.finished
+        }
+
+class Contest:
+    """
+        One contest: its state, storage and work in progress. All contests share judges.
+    """
+    def __init__( self, name, prefix ):
+        self.name, self.wolf, self.testing = name, None, {}
+        self.rejudges = {} # job id → Rejudge, in order of start
+        self.waiting = {} # problem → submits which wait for its checker
+        self.shedulers = {
+            'checker_compile': sheduler(self, action_checker_compile),
+            'solution_compile': sheduler(self, action_submit_compile),
+            'solution_test': sheduler(self, action_submit_test)
+        }
+        self.data = Data(
+            {'wolf': self.replay_wolf}, prefix + '.bin', prefix + ".log", externals={'shedulers': self.shedulers},
+            format=args.log_format, dedup=args.dedup, durability=args.durability, workers=args.replay_workers,
+            segment_size=args.segment_size, cache_size=args.cache_size, compression=args.compression, version=core.VERSION,
+            replica=args.replica
+        )
+    def replay_wolf( self, timestamp, parameters ):
+        self.wolf = core.Wolf(timestamp, self.shedulers, self.data)
+        self.data.replayers = self.wolf.replayers()
+    def restore_wolf( self, state ):
+        self.wolf = state
+        self.data.replayers = self.wolf.replayers()
+
+def switch( contest ):
+    """
+        Make contest current: actions work with wolf and data of the current contest.
+    """
+    global current, wolf, data, testing
+    current, wolf, data, testing = contest, contest.wolf, contest.data, contest.testing
+
+def within( contest, function ):
+    """
+        Bind function to contest, for callbacks which are called later.
+    """
+    def call( *arguments ):
+        switch(contest)
+        return function(*arguments)
+    return call
+
+def rejudge_start( submits ):
+    """
+        Start rejudge of given submits in the current contest, return id of the job.
+    """
+    global rejudge_id
+    job = Rejudge(rejudge_id, submits)
+    rejudge_id += 1
+    current.rejudges[job.id] = job
+    log("rejudge #%d of %d submits started" % (job.id, job.total))
+    return job.id
+
+def rejudge_feed():
+    """
+        Count rejudged submits which got results and reset next ones, so that up to
+        --rejudge-batch submits of each contest are rejudged at once. Returns True if
+        any rejudge is in progress.
+    """
+    busy = False
+    for contest in contests.values():
+        jobs = [job for job in contest.rejudges.values() if job.active()]
+        if not jobs:
+            continue
+        switch(contest)
+        for job in jobs:
+            for id in [x for x in job.running if wolf.submit_get(x).result is not None]:
+                job.running.remove(id)
+                job.done += 1
+        running = sum(len(job.running) for job in jobs)
+        for job in jobs:
+            for i in range(len(job.pending)):
+                if running >= args.rejudge_batch:
+                    break
+                id = job.pending.popleft()
+                submit = wolf.submit_get(id)
+                if submit.result is None:
+                    # submit is being judged already, it gets a new result anyway
+                    job.skipped += 1
+                    continue
+                checker = wolf.problem_get(submit.problem).checker
+                if checker is None or not isinstance(checker.binary, str):
+                    # checker is not compiled yet, submit would wait for it without progress
+                    job.pending.append(id)
+                    continue
+                data.create('submit.rejudge', [id])
+                job.running.add(id)
+                running += 1
+            if not job.pending and not job.running:
+                job.finished = time.time()
+                log("rejudge #%d finished: %d submits rejudged, %d skipped" % (job.id, job.done, job.skipped))
+            busy = busy or job.active()
+    return busy
+
+def relocate( moved, dropped ):
+    wolf.content_relocate(moved, dropped)
+    if args.snapshot_interval > 0:
+        data.snapshot(wolf) # old snapshots are removed by compaction
+
+current, wolf, data, testing = None, None, None, None
+
+rejudge_id = 0
+
+judges = [] # all connected judges
+free_judges = [] # free slots of judges (judge is listed once for each of them), in order of their arrival
+judge_queue = JudgeQueue()
 
 actions = Queue()
 
 problems = Queue()
 
-shedulers = {
-    'checker_compile': lambda id: actions.push((action_checker_compile, (id,))),
-    'solution_compile': lambda id: actions.push((action_submit_compile, (id,))),
-    'solution_test': lambda id, test: actions.push((action_submit_test, (id, test)))
-}
-
-data = data.Data(replayers, args.data + '.bin', args.data + ".log")
-data.start()
+replaying = True # work is not sheduled during replay, wolf.reschedule finds what is unfinished after it
+
+def sheduler( contest, action ):
+    def shedule( *arguments ):
+        if not replaying:
+            actions.push((within(contest, action), arguments))
+    return shedule
+
+contests = {}
+for x in args.data:
+    name, prefix = x.split('=', 1) if '=' in x else (os.path.basename(x), x)
+    if name in contests:
+        parser.error("contest %s is given twice" % name)
+    contests[name] = Contest(name, prefix)
+default_contest = next(iter(contests))
+for contest in contests.values():
+    log("loading contest %s" % contest.name)
+    contest.data.start(contest.restore_wolf)
+if not args.replica: # replica never schedules work, the primary does it
+    replaying = False
+    for contest in contests.values():
+        if contest.wolf is not None:
+            contest.wolf.reschedule()
+switch(contests[default_contest])
 
 sys.stdout.flush()
+while args.replica:
+    for contest in contests.values():
+        contest.data.follow()
+    queue = poll(args.follow_interval)
+    for action, arguments in queue:
+        queue.extend(action(*arguments))
+
 while True:
+    rejudging = rejudge_feed()
     while actions:
         action, arguments = actions.pop()
         action(*arguments)
-    queue = poll() # Вместе вырвем себе мозг?
+    for contest in contests.values():
+        contest.data.commit()
+        if args.snapshot_interval > 0 and contest.data.unsaved() >= args.snapshot_interval:
+            contest.data.snapshot(contest.wolf)
+    judge_check_deadlines()
+    busy = rejudging or any(x.data.compacting() for x in contests.values()) or any(x.working() for x in judges)
+    queue = poll(1.0 if busy else None) # Вместе вырвем себе мозг?
     for action, arguments in queue:
         queue.extend(action(*arguments))
 
@@ -0,0 +1,87 @@
+import collections
+
+class Cache:
+    """
+        Copies of content blobs kept in memory, by hash, with total size limited by budget.
+        Least recently used blobs are evicted first. Pinned blobs (tests of problems which
+        are being tested now, for example) are never evicted, they are still counted in
+        total size, so cache can be over budget if too much is pinned.
+    """
+
+    def __init__( self, budget ):
+        self.budget = budget
+        self.__lru = collections.OrderedDict() # hash → bytes, oldest first
+        self.__pinned = {} # hash → bytes of pinned blobs which are loaded
+        self.__owners = {} # owner → set of hashes pinned by it
+        self.__pins = collections.Counter() # hash → number of owners which pinned it
+        self.__size = 0
+        self.__stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0}
+
+    def get( self, hash, load ):
+        """
+            Return memoryview of blob, load() is called to get it on miss.
+        """
+        if hash in self.__pinned:
+            self.__stats['hits'] += 1
+            return memoryview(self.__pinned[hash])
+        if hash in self.__lru:
+            self.__stats['hits'] += 1
+            self.__lru.move_to_end(hash)
+            return memoryview(self.__lru[hash])
+        self.__stats['misses'] += 1
+        value = bytes(load())
+        if hash in self.__pins:
+            self.__pinned[hash] = value
+        elif len(value) <= self.budget:
+            self.__lru[hash] = value
+        else:
+            return memoryview(value)
+        self.__size += len(value)
+        self.__evict()
+        return memoryview(value)
+
+    def pin( self, owner, hashes ):
+        """
+            Pin blobs on behalf of owner, replacing blobs previously pinned by it.
+        """
+        self.unpin(owner)
+        self.__owners[owner] = set(hashes)
+        for hash in self.__owners[owner]:
+            self.__pins[hash] += 1
+            if hash in self.__lru:
+                self.__pinned[hash] = self.__lru.pop(hash)
+
+    def unpin( self, owner ):
+        for hash in self.__owners.pop(owner, ()):
+            self.__pins[hash] -= 1
+            if self.__pins[hash] == 0:
+                del self.__pins[hash]
+                if hash in self.__pinned:
+                    self.__lru[hash] = self.__pinned.pop(hash)
+        self.__evict()
+
+    def discard( self, hash ):
+        """
+            Forget blob, for content which was dropped from storage.
+        """
+        value = self.__lru.pop(hash, None)
+        if value is None:
+            value = self.__pinned.pop(hash, None)
+        if value is not None:
+            self.__size -= len(value)
+
+    def __evict( self ):
+        while self.__size > self.budget and self.__lru:
+            hash, value = self.__lru.popitem(last=False)
+            self.__size -= len(value)
+            self.__stats['evictions'] += 1
+            self.__stats['evicted_bytes'] += len(value)
+
+    def stats( self ):
+        """
+            Counters of hits, misses and evictions, and current size of cache.
+        """
+        return dict(self.__stats,
+            budget=self.budget, size=self.__size, blobs=len(self.__lru) + len(self.__pinned),
+            pinned=len(self.__pinned), pinned_bytes=sum(len(x) for x in self.__pinned.values())
+        )
@@ -1,4 +1,9 @@
+import array, bisect, collections
 from .common import log
+from .standings import Standings
+from .treap import Treap
+
+VERSION = 8 # version of state classes, snapshots of other versions are not loaded
 
 class Checker:
     def __init__( self, source, compiler ):
@@ -10,11 +15,17 @@ class Compiler:
         self.id, self.binary, self.compile, self.run = id, binary, compile, run
 
 class Content:
-    def __init__( self, hash, name, time, start, size, data ):
+    __slots__ = ('hash', 'name', 'time', '__start', '__size', '__data', '__codec')
+    def __init__( self, hash, name, time, start, size, data, codec=None ):
         self.hash, self.name, self.time = hash, name, time
-        self.__start, self.__size, self.__data = start, size, data
+        self.__start, self.__size, self.__data, self.__codec = start, size, data, codec
     def load( self ):
-        return self.__data.load(self.__start, self.__size)
+        """
+            Return content as memoryview (see Data.load), use bytes() to get a copy.
+        """
+        return self.__data.load(self.__start, self.__size, self.hash, self.__codec)
+    def move( self, start ):
+        self.__start = start
 
 class Problem:
     def __init__( self, name, full ):
@@ -25,56 +36,170 @@ class Problem:
         self.memory_limit = None
         self.input = None
         self.output = None
+        self.parallel = 1 # number of tests of one submit which are tested at once
+        self.deterministic = False # results of tests can be reused for the same binary, test and checker
 
 class Submit:
+    """
+        Tests are not copied: submit refers to the list of tests of its problem (which is only
+        appended to) and remembers how many tests there were. Results of tests are stored in
+        arrays which are allocated with the first result.
+        Testings are tests which are being tested, tests are started in order by dispatch,
+        several at once if problem allows it. Result is the first failed test in order, so
+        after a failure only earlier tests are waited for and later ones are forgotten.
+    """
+    __slots__ = (
+        'time', 'problem', 'source', 'compiler', 'testings', 'last_test', 'result', 'binary', 'compiler_output', 'origin', 'round',
+        '__definitions', '__count', '__status', '__time', '__memory', '__next'
+    )
+    STATUSES = (None, 'OK', 'CE', 'WA', 'PE', 'RT', 'TL', 'ML', 'Fail') # test statuses are stored by index in this list
+
     def __init__( self, time, problem, source, compiler, tests ):
         self.time, self.problem, self.source, self.compiler = time, problem, source, compiler
-        self.tests = [Test(*x) for x in tests]
-        self.testings = {0}
+        self.__definitions, self.__count = tests, len(tests)
+        self.__status = self.__time = self.__memory = None
+        self.testings = set()
+        self.__next = 0 # tests before it are started; after a failure it follows the failed test
         self.last_test = None
         self.result = None
         self.binary = None
+        self.compiler_output = None
+        self.origin = None
+        self.round = 0 # number of rejudges, answers of judges to earlier rounds are dropped
+    @property
+    def tests( self ):
+        return Tests(self, self.__count)
+    def test_definition( self, test ):
+        return self.__definitions[test]
+    def test_result( self, test ):
+        """
+            Return (status, time peak, memory peak) of test, status is None if test is not tested.
+        """
+        if self.__status is None or self.__status[test] == 0:
+            return None, None, None
+        return Submit.STATUSES[self.__status[test]], self.__time[test], self.__memory[test]
+    def reset( self, tests ):
+        """
+            Forget compilation and results, so submit is judged again on given tests.
+        """
+        self.__definitions, self.__count = tests, len(tests)
+        self.__status = self.__time = self.__memory = None
+        self.testings = set()
+        self.__next = 0
+        self.last_test = None
+        self.result = None
+        self.binary = None
+        self.compiler_output = None
+        self.round += 1
+    def test_set_result( self, test, status, time_peak, memory_peak ):
+        if self.__status is None:
+            self.__status = array.array('B', bytes(self.__count))
+            self.__time = array.array('d', bytes(8 * self.__count))
+            self.__memory = array.array('q', bytes(8 * self.__count))
+        assert 0 <= test < self.__count
+        self.__status[test] = Submit.STATUSES.index(status)
+        self.__time[test], self.__memory[test] = time_peak, int(memory_peak)
+    def dispatch( self, width ):
+        """
+            Start next tests, so that up to width tests are tested at once, and return list of
+            started tests. Nothing is started after a failure.
+        """
+        started = []
+        if self.result is None and not self.__failed():
+            while len(self.testings) < width and self.__next < self.__count:
+                self.testings.add(self.__next)
+                started.append(self.__next)
+                self.__next += 1
+            self.__settle()
+        return started
     def tested( self, test, status, time, memory ):
         assert test in self.testings
         self.testings.remove(test)
-        self.tests[test].result(status, time, memory)
+        self.test_set_result(test, status, time, memory)
         self.last_test = test
-        if len(self.testings) == 0:
-            test = self.last_test + 1
-            if status == "OK" and test < len(self.tests):
-                self.testings.add(test)
-            else:
-                if status == "OK":
-                    self.last_test = None
-                    status = "AC"
-                self.result = (status, self.last_test)
+        if status != "OK":
+            self.testings = {x for x in self.testings if x < test}
+            self.__next = test + 1
+        self.__settle()
+    def __failed( self ):
+        return self.__next > 0 and self.test_result(self.__next - 1)[0] not in (None, "OK")
+    def __settle( self ):
+        if self.testings or self.result is not None:
+            return
+        if self.__failed():
+            self.last_test = self.__next - 1
+            self.result = (self.test_result(self.last_test)[0], self.last_test)
+        elif self.__next == self.__count:
+            self.last_test = None
+            self.result = ("AC", None)
 
 class Team:
     def __init__( self, login, name, password ):
         self.login, self.name, self.password = login, name, password
 
+class Tests:
+    """
+        Sequence of tests of submit, made on demand by Submit.tests.
+    """
+    __slots__ = ('__submit', '__count')
+    def __init__( self, submit, count ):
+        self.__submit, self.__count = submit, count
+    def __len__( self ):
+        return self.__count
+    def __getitem__( self, test ):
+        if not 0 <= test < self.__count:
+            raise IndexError("test index out of range")
+        return Test(self.__submit, test)
+    def __iter__( self ):
+        return (Test(self.__submit, test) for test in range(self.__count))
+
 class Test:
-    def __init__( self, test, answer ):
-        self.test, self.answer = test, answer
-        self.status = None
-        self.output = None
+    """
+        Test of submit: view of its definition and its result stored in the submit.
+    """
+    __slots__ = ('__submit', '__index')
+    output = None
+    def __init__( self, submit, index ):
+        self.__submit, self.__index = submit, index
+    @property
+    def test( self ):
+        return self.__submit.test_definition(self.__index)[0]
+    @property
+    def answer( self ):
+        return self.__submit.test_definition(self.__index)[1]
+    @property
+    def status( self ):
+        return self.__submit.test_result(self.__index)[0]
+    @property
+    def time_peak( self ):
+        return self.__submit.test_result(self.__index)[1]
+    @property
+    def memory_peak( self ):
+        return self.__submit.test_result(self.__index)[2]
     def result( self, status, time_peak, memory_peak ):
-        self.status, self.time_peak, self.memory_peak = status, time_peak, memory_peak
+        self.__submit.test_set_result(self.__index, status, time_peak, memory_peak)
 
 class Archive:
     def __init__( self ):
         self.problems = set()
-        self.problem_list = []
+        self.problem_list = Treap() # removal by position happens during replay
         self.submits_all = []
         self.submits_team = {}
         self.submits_problem = {}
         self.submits = {}
+        self.submits_time = [] # times of submits in submits_all, they come in order of time
+        self.submits_compiler = {}
+        self.submits_verdict = {} # verdict → sorted list of finished submits
         self.compilers = {}
     def add_problem( self, problem ):
         self.problems.add(problem)
         self.problem_list.append(problem)
-    def add_submit( self, team, problem, id ):
+    def add_submit( self, team, problem, id, compiler, time ):
         self.submits_all.append(id)
+        self.submits_time.append(time)
+        if compiler not in self.submits_compiler:
+            self.submits_compiler[compiler] = []
+        self.submits_compiler[compiler].append(id)
         if team not in self.submits_team:
             self.submits_team[team] = []
         self.submits_team[team].append(id)
@@ -84,8 +209,19 @@ class Archive:
         if (team, problem) not in self.submits:
             self.submits[(team, problem)] = []
         self.submits[(team, problem)].append(id)
+    def set_verdict( self, id, verdict, previous=None ):
+        if previous is not None:
+            self.clear_verdict(id, previous)
+        if verdict not in self.submits_verdict:
+            self.submits_verdict[verdict] = []
+        bisect.insort(self.submits_verdict[verdict], id)
+    def clear_verdict( self, id, verdict ):
+        submits = self.submits_verdict[verdict]
+        del submits[bisect.bisect_left(submits, id)]
 
 class Wolf:
+    VERDICTS = 1 << 16 # results of tests kept for reuse on deterministic problems, least recently used are forgotten
+
     def __init__( self, timestamp, shedulers, data ):
         self.__timestamp = timestamp
         self.__shedulers = shedulers
@@ -96,6 +232,9 @@ class Wolf:
         self.__teams = {}
         self.__data = data
         self.__archive = Archive()
+        self.__standings = Standings() # of archive submits, penalty of each team counts from its first submit
+        self.__compiled = {} # (source, name, compiler, binary and compile strings) → (binary, output) of successful compilations
+        self.__verdicts = collections.OrderedDict() # see __verdict_key → (status, time, memory), oldest use first
 
     def replayers( self ):
         return {
@@ -112,12 +251,15 @@ class Wolf:
             'problem.checker.recompile': self.replay_problem_checker_recompile,
             'problem.checker.set': self.replay_problem_checker_set,
             'problem.create': self.replay_problem_create,
+            'problem.deterministic.set': self.replay_problem_deterministic_set,
             'problem.files.set': self.replay_problem_files_set,
             'problem.limits.set': self.replay_problem_limits_set,
             'problem.modify': self.replay_problem_modify,
+            'problem.parallel.set': self.replay_problem_parallel_set,
             'problem.test.add': self.replay_problem_test_add,
             'submit': self.replay_submit,
             'submit.compiled': self.replay_submit_compiled,
+            'submit.rejudge': self.replay_submit_rejudge,
             'submit.test': self.replay_submit_test,
             'team.add': self.replay_team_add,
             'team.modify': self.replay_team_modify
@@ -142,7 +284,7 @@ class Wolf:
         assert len(self.__submits) == id
         problem = int(problem)
         assert problem in self.__archive.problems
-        self.__archive.add_submit(team, problem, id)
+        self.__archive.add_submit(team, problem, id, compiler, timestamp)
         submit = Submit(timestamp, problem, source, compiler, self.__problems[problem].tests)
         submit.origin = (None, team)
         self.__submits.append(submit)
@@ -150,9 +292,7 @@ class Wolf:
     def replay_archive_remove( self, timestamp, parameters ):
         local_id = int(*parameters)
         assert 0 <= local_id < len(self.__archive.problem_list)
-        # todo: optimize using treap
-        problem_id = self.__archive.problem_list[local_id]
-        del self.__archive.problem_list[local_id]
+        problem_id = self.__archive.problem_list.pop(local_id)
         self.__archive.problems.remove(problem_id)
     def replay_compiler_add( self, timestamp, parameters ):
         id, binary, compile, run = parameters
@@ -162,21 +302,27 @@ class Wolf:
         id, binary, compile, run = parameters
         assert id in self.__compilers
         self.__compilers[id] = Compiler(id, binary, compile, run)
+        self.__compiled_forget(id)
     def replay_compiler_remove( self, timestamp, parameters ):
         id = parameters[0]
         del self.__compilers[id]
+        self.__compiled_forget(id)
     def replay_content( self, timestamp, parameters ):
-        hash, name, start, size = parameters
+        hash, name, start, size = parameters[:4]
+        codec = parameters[4] if len(parameters) > 4 else None
         start = int(start)
         size = int(size)
-        self.__content[hash] = Content(hash, name, timestamp, start, size, self.__data)
+        self.__content[hash] = Content(hash, name, timestamp, start, size, self.__data, codec)
     def replay_problem_checker_compiled( self, timestamp, parameters ):
         id, binary, output = parameters
         id = int(id)
         assert self.__problems[id].checker is not None
         self.__problems[id].checker.binary = binary
+        self.__compiled_add(self.__problems[id].checker.source, self.__problems[id].checker.compiler, binary, output)
     def replay_problem_checker_recompile( self, timestamp, parameters ):
         id = int(parameters[0])
+        checker = self.__problems[id].checker
+        self.__compiled.pop(self.__compile_key(checker.source, checker.compiler), None) # compile it for real
         self.__problems[id].checker.binary = None
         self.__shedulers['checker_compile'](id)
     def replay_problem_checker_set( self, timestamp, parameters ):
@@ -198,6 +344,16 @@ class Wolf:
         id, time, memory = int(id), float(time), int(memory)
         self.__problems[id].time_limit = time
         self.__problems[id].memory_limit = memory
+    def replay_problem_deterministic_set( self, timestamp, parameters ):
+        id, deterministic = parameters
+        id = int(id)
+        assert 0 <= id < len(self.__problems)
+        self.__problems[id].deterministic = bool(int(deterministic))
+    def replay_problem_parallel_set( self, timestamp, parameters ):
+        id, parallel = parameters
+        id, parallel = int(id), int(parallel)
+        assert 0 <= id < len(self.__problems) and parallel >= 1
+        self.__problems[id].parallel = parallel
     def replay_problem_modify( self, timestamp, parameters ):
         id, name, full = parameters
         id = int(id)
@@ -220,20 +376,35 @@ class Wolf:
         id = int(id)
         self.__submits[id].binary = binary if binary != '' else False
         self.__submits[id].compiler_output = output
+        self.__compiled_add(self.__submits[id].source, self.__submits[id].compiler, binary, output)
         if self.__submits[id].binary is not False:
-            for test in self.__submits[id].testings:
-                self.__shedulers['solution_test'](id, test)
+            self.__dispatch(id)
         else:
             self.__submits[id].result = ('CE', None)
+            self.__finished(id)
+    def replay_submit_rejudge( self, timestamp, parameters ):
+        id = int(*parameters)
+        assert 0 <= id < len(self.__submits)
+        submit = self.__submits[id]
+        if submit.result is not None and submit.origin is not None:
+            self.__archive.clear_verdict(id, submit.result[0])
+            self.__standings.remove(submit.origin[1], submit.problem, submit.time, id, submit.result[0])
+        submit.reset(self.__problems[submit.problem].tests)
+        self.__shedulers['solution_compile'](id)
     def replay_submit_test( self, timestamp, parameters ):
         id, test, status, time_peak, memory_peak = parameters
         id = int(id)
         test = int(test)
         time_peak = float(time_peak)
         memory_peak = float(memory_peak)
+        key = self.__verdict_key(self.__submits[id], test)
+        if key is not None and status != 'Fail':
+            self.__verdicts[key] = (status, time_peak, memory_peak)
+            self.__verdicts.move_to_end(key)
+            if len(self.__verdicts) > Wolf.VERDICTS:
+                self.__verdicts.popitem(last=False)
         self.__submits[id].tested(test, status, time_peak, memory_peak)
-        for test in self.__submits[id].testings:
-            self.__shedulers['solution_test'](id, test)
+        self.__dispatch(id)
     def replay_team_add( self, timestamp, parameters ):
         login, name, password = parameters
         assert login not in self.__teams
@@ -245,6 +416,8 @@ class Wolf:
 
     def archive_get( self ):
         return self.__archive
+    def standings_get( self ):
+        return self.__standings
     def compiler_get( self, id ):
         return self.__compilers.get(id)
     def compiler_list( self ):
@@ -262,10 +435,202 @@ class Wolf:
     def team_get( self, login ):
         return self.__teams.get(login)
 
+    def reschedule( self ):
+        """
+            Pass all unfinished work to schedulers. Used once after the event log is loaded
+            (schedulers are muted during replay, which would find lots of work that is
+            finished later in the log) or state is restored from a snapshot.
+        """
+        for id, problem in enumerate(self.__problems):
+            if problem.checker is None or problem.checker.binary not in (None, False):
+                continue
+            # False means compilation was in progress when state was saved
+            problem.checker.binary = None
+            self.__shedulers['checker_compile'](id)
+        for id, submit in enumerate(self.__submits):
+            if submit.result is not None:
+                continue
+            if submit.binary is None:
+                self.__shedulers['solution_compile'](id)
+            else:
+                for test in submit.testings:
+                    self.__shedulers['solution_test'](id, test)
+
+    def __compile_key( self, source, compiler ):
+        # result of compilation depends on content, its name and compiler command lines
+        content, compiler = self.__content.get(source), self.__compilers.get(compiler)
+        if content is None or compiler is None:
+            return None
+        return (source, content.name, compiler.id, compiler.binary, compiler.compile)
+    def __compiled_add( self, source, compiler, binary, output ):
+        # failed compilation is not reused: it may be caused by a broken judge, rejudge tries again
+        key = self.__compile_key(source, compiler)
+        if key is not None and binary != '':
+            self.__compiled[key] = (binary, output)
+    def __compiled_forget( self, compiler ):
+        self.__compiled = {key: value for key, value in self.__compiled.items() if key[2] != compiler}
+
+    def compiled_get( self, source, compiler ):
+        """
+            Return (binary, output) of earlier compilation of the same source with the same
+            compiler, or None if there is no such successful compilation.
+        """
+        compiled = self.__compiled.get(self.__compile_key(source, compiler))
+        if compiled is not None and any(self.__data.dropping(x) for x in compiled if x):
+            return None # content is dead, running compaction drops it
+        return compiled
+
+    def __verdict_key( self, submit, test ):
+        # everything which result of test depends on: binary and its name, test, checker, run strings, limits and files
+        problem = self.__problems[submit.problem]
+        if not problem.deterministic or problem.checker is None or not isinstance(submit.binary, str):
+            return None
+        compiler, checker_compiler = self.__compilers.get(submit.compiler), self.__compilers.get(problem.checker.compiler)
+        binary = self.__content.get(submit.binary)
+        if compiler is None or checker_compiler is None or binary is None:
+            return None
+        return (submit.binary, binary.name) + tuple(submit.test_definition(test)) + (
+            problem.checker.binary, compiler.run, checker_compiler.run,
+            problem.time_limit, problem.memory_limit, problem.input, problem.output
+        )
+
+    def verdict_get( self, id, test ):
+        """
+            Return (status, time, memory) of the same test of an equal run of deterministic
+            problem, or None if it is unknown.
+        """
+        key = self.__verdict_key(self.__submits[id], test)
+        if key not in self.__verdicts:
+            return None
+        self.__verdicts.move_to_end(key)
+        return self.__verdicts[key]
+
+    def content_tests( self, id ):
+        """
+            Return set of hashes of content needed to test solutions of problem: tests,
+            answers and checker binary.
+        """
+        problem = self.__problems[id]
+        hashes = set()
+        for test, answer in problem.tests:
+            hashes.update((test, answer))
+        if problem.checker is not None and isinstance(problem.checker.binary, str):
+            hashes.add(problem.checker.binary)
+        return hashes
+
+    def content_live( self ):
+        """
+            Return set of hashes of content which is referenced by current state.
+        """
+        live = set()
+        for problem in self.__problems:
+            for test, answer in problem.tests:
+                live.update((test, answer))
+            if problem.checker is not None:
+                live.add(problem.checker.source)
+                if isinstance(problem.checker.binary, str):
+                    live.add(problem.checker.binary)
+        for submit in self.__submits:
+            live.add(submit.source)
+            if isinstance(submit.binary, str):
+                live.add(submit.binary)
+            if submit.compiler_output is not None:
+                live.add(submit.compiler_output)
+        return live
+
+    def content_relocate( self, moved, dropped ):
+        """
+            Apply result of Data.compact: move content to new addresses and forget dropped one.
+        """
+        for hash, start in moved.items():
+            self.__content[hash].move(start)
+        for hash in dropped:
+            self.__content.pop(hash, None)
+        if dropped:
+            self.__compiled = {
+                key: (binary, output) for key, (binary, output) in self.__compiled.items()
+                if binary not in dropped and output not in dropped and key[0] not in dropped
+            }
+            self.__verdicts = collections.OrderedDict(
+                (key, value) for key, value in self.__verdicts.items()
+                if not any(x in dropped for x in (key[0], key[2], key[3], key[4]))
+            )
+
+    def archive_submits( self, team=None, problem=None, verdict=None, compiler=None, time_from=None, time_to=None, cursor=None, limit=20 ):
+        """
+            Return list of at most limit archive submits, newest first, which match all given
+            filters and next cursor (None if there are no more submits). Time range is
+            [time_from, time_to), cursor is the last id of previous page. Submits are taken from
+            the shortest of matching indexes, the rest of filters are checked on them.
+        """
+        archive = self.__archive
+        indexes = [archive.submits_all]
+        if team is not None and problem is not None:
+            indexes.append(archive.submits.get((team, problem), []))
+        elif team is not None:
+            indexes.append(archive.submits_team.get(team, []))
+        elif problem is not None:
+            indexes.append(archive.submits_problem.get(problem, []))
+        if verdict is not None:
+            indexes.append(archive.submits_verdict.get(verdict, []))
+        if compiler is not None:
+            indexes.append(archive.submits_compiler.get(compiler, []))
+        submits = min(indexes, key=len)
+        def bound( time ):
+            # id of the first submit made at this time or later
+            if time is None:
+                return None
+            index = bisect.bisect_left(archive.submits_time, time)
+            return archive.submits_all[index] if index < len(archive.submits_all) else len(self.__submits)
+        first, last = bound(time_from), bound(time_to)
+        if cursor is not None:
+            last = cursor if last is None else min(last, cursor)
+        low = bisect.bisect_left(submits, first) if first is not None else 0
+        position = bisect.bisect_left(submits, last) if last is not None else len(submits)
+        result = []
+        while position > low and len(result) < limit:
+            position -= 1
+            id = submits[position]
+            submit = self.__submits[id]
+            if team is not None and submit.origin[1] != team or problem is not None and submit.problem != problem or \
+                    compiler is not None and submit.compiler != compiler or \
+                    verdict is not None and (submit.result is None or submit.result[0] != verdict):
+                continue
+            result.append(id)
+        return result, result[-1] if len(result) == limit and position > low else None
+
+    def submits_find( self, problem=None, verdict=None, time_from=None, time_to=None ):
+        """
+            Return ids of finished submits (of contest and archive) which match all given
+            filters, oldest first. Time range is [time_from, time_to).
+        """
+        return [
+            id for id, submit in enumerate(self.__submits)
+            if submit.result is not None and (problem is None or submit.problem == problem) and
+                (verdict is None or submit.result[0] == verdict) and
+                (time_from is None or submit.time >= time_from) and (time_to is None or submit.time < time_to)
+        ]
+
+    def __dispatch( self, id ):
+        """
+            Start next tests of submit, or count its result if it is known.
+        """
+        submit = self.__submits[id]
+        for test in submit.dispatch(self.__problems[submit.problem].parallel):
+            self.__shedulers['solution_test'](id, test)
+        if submit.result is not None:
+            self.__finished(id)
+
+    def __finished( self, id ):
+        submit = self.__submits[id]
+        if submit.origin is not None:
+            self.__archive.set_verdict(id, submit.result[0])
+            self.__standings.add(submit.origin[1], submit.problem, submit.time, id, submit.result[0])
+
     def force_submit_test( self, id ):
         if self.__submits[id].binary is not False:
-            for test in self.__submits[id].testings:
-                self.__shedulers['solution_test'](id, test)
+            self.__dispatch(id)
         else:
             self.__submits[id].result = ('CE', None)
+            self.__finished(id)
 
@@ -1,86 +1,572 @@
-import hashlib, io, sys, time
+import bisect, collections, concurrent.futures, gc, hashlib, lzma, os, sys, threading, time, zlib
+from . import eventlog
+from .cache import Cache
 from .common import log
+from .segment import Manifest, Segment
+from .snapshot import Snapshots
 
 class Data:
-    def __init__( self, replayers, binfile, logfile ):
+    FINGERPRINT = 4096 # number of log bytes before snapshot offset which are checked on loading snapshot
+    CHUNK = 1 << 22 # event log is read and parsed by chunks of this size
+    PARALLEL = 1 << 24 # logs smaller than this are parsed without process pool
+    PROGRESS = 5.0 # seconds between progress reports during replay
+    DEDUP = ['none', 'md5', 'sha256']
+    DURABILITY = ['none', 'flush', 'fsync']
+    COMPRESSION = ['none', 'zlib', 'lzma']
+    COMPRESS_MIN = 1024 # smaller content is always stored raw
+    COMPRESS_RATIO = 0.9 # content is stored compressed only if it becomes at most this fraction of its size
+    CODECS = {
+        'zlib': (lambda x: zlib.compress(x, 6), zlib.decompress),
+        'lzma': (lzma.compress, lzma.decompress)
+    }
+
+    def __init__( self, replayers, binfile, logfile, externals={}, format='text', dedup='md5', durability='flush', workers=None, segment_size=1 << 30, cache_size=0, compression='none', version=None, replica=False ):
+        """
+            Format is used only for a new (empty) event log, format of existing log is detected.
+            Dedup is the way to check that saved content is already stored: 'md5' trusts equal
+            md5 and size, 'sha256' also compares sha256 of both blobs, 'none' always appends.
+            Durability is what commit does with a batch of events: 'none' leaves it in buffers,
+            'flush' passes it to the OS, 'fsync' also waits until it reaches the disk.
+            Workers is the number of processes which parse event log on start (default: number
+            of CPUs), events are replayed in order in the main process anyway.
+            Event log and binary storage are split into segments of about segment_size bytes
+            (see segment.Manifest), sealed segments are rewritten only by compact.
+            Cache_size is byte budget of in-memory cache of decompressed content, 0 disables it.
+            Compression is the codec for new content which is big and compressible enough,
+            codec of each stored blob is recorded in its content event.
+            Version is stored in snapshots, snapshots of other versions of state are not loaded.
+            Replica only reads data files written by another process (the primary): events
+            which the primary appends are replayed by follow(), nothing is ever written.
+        """
+        assert dedup in Data.DEDUP and durability in Data.DURABILITY and compression in Data.COMPRESSION
+        self.__compression = compression
+        self.__version = version
+        self.__durability = durability
+        self.__workers = workers if workers is not None else Data.__cpus()
+        self.__segment_size = segment_size
+        self.__pending = [] # events created since last commit
+        self.__waiting = [] # callbacks to call after commit
+        self.__stats = {
+            'commits': 0, 'events': 0, 'bytes': 0,
+            'batch_last': 0, 'batch_max': 0, 'batches': {}, # batches: number of commits by batch size rounded up to power of two
+            'time_last': 0.0, 'time_max': 0.0, 'time_total': 0.0
+        }
         self.replayers = replayers
+        self.__replayers = replayers # replica loads state again with them after compaction
         self.__binfile, self.__logfile = binfile, logfile
+        self.__default_format = format
+        self.__dedup = dedup
+        self.__contents = {} # hash → (name, start, size) of stored content
+        self.__strong = {} # hash → sha256 of stored content, filled lazily
+        self.__codecs = {} # hash → (codec, size before compression) of compressed content
+        self.__compaction = None # state of running compaction
+        self.cache = Cache(cache_size)
+        self.__snapshots = Snapshots(logfile, dict(externals, data=self))
+        self.__unsaved = 0
+        self.__replica = replica
+        self.__offset = 0 # replica: end of replayed part of event log
+        self.__synced = None # replica: time when replayed part reached the end of log last time
+        self.__last_event = None # replica: timestamp of the last replayed event
+
+    @staticmethod
+    def __cpus():
+        # CPUs this process may run on, which can be fewer than CPUs of the host
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return os.cpu_count() or 1
 
-    def start( self ):
+    def start( self, restore=None ):
+        """
+            Open data files and replay event log. If restore is given, newest valid snapshot
+            is loaded and passed to it, then only events after the snapshot are replayed.
+        """
         self.__start = time.time()
-        self.__bin = open(self.__binfile, 'r+b')
-        size = self.__bin.seek(0, io.SEEK_END)
-        log(("opened index log (%s), size: %d bytes") % (self.__binfile, size))
+        self.__restore = restore
+        self.__manifest = Manifest(self.__logfile, self.__binfile)
+        self.__bins = [Segment(path, base) for path, base in self.__manifest.bin]
+        if not self.__replica:
+            self.__bins[-1].open()
+        log(("opened index log (%s), size: %d bytes in %d segments") % (self.__binfile, sum(x.size for x in self.__bins), len(self.__bins)))
+
+        self.__logs = []
+        for path in self.__manifest.log:
+            self.__logs.append(Segment(path, self.__logs[-1].end() if self.__logs else 0))
+        with open(self.__logs[0].path, 'rb') as events:
+            self.__format = eventlog.detect(events.read(len(eventlog.BinaryFormat.MAGIC)), self.__default_format)
+        if self.__logs[-1].size == 0 and not self.__replica:
+            self.__logs[-1].open().write(self.__format.header)
+            self.__logs[-1].close()
+        log("event log format: %s" % self.__format.name)
+
+        offset = len(self.__format.header)
+        if restore is not None:
+            snapshot = self.__snapshots.load(self.__snapshot_valid)
+            if snapshot is not None and snapshot[0].get('version') != self.__version:
+                log("WARNING: snapshot is made by another version of state, ignoring it")
+                snapshot = None
+            if snapshot is not None:
+                state, offset, bin_size = snapshot
+                self.__contents = state['contents']
+                self.__codecs = state.get('codecs', {})
+                restore(state['state'])
+                log("loaded snapshot at offset %d in %.2f seconds" % (offset, time.time() - self.__start))
 
         count = 0
-        with open(self.__logfile, 'r') as events:
-            for line in events.readlines():
-                self.__replay(line)
-                count += 1
-            size = events.tell()
+        total = self.__logs[-1].end() - offset
+        done, report = 0, time.time() + Data.PROGRESS
+        # replay makes lots of objects and no garbage cycles, collector would rescan them again and again
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            for length, records in self.__parse(self.__logs, offset, total):
+                for timestamp, event, parameters in records:
+                    self.__replay(timestamp, event, parameters)
+                if records:
+                    self.__last_event = records[-1][0]
+                count += len(records)
+                done += length
+                if time.time() >= report:
+                    report = time.time() + Data.PROGRESS
+                    log("replayed %d events (%.0f events/s), %d bytes remaining" % (count, count / (time.time() - self.__start), total - done))
+        finally:
+            if collecting:
+                gc.enable()
         time_read = time.time() - self.__start
-        log("read %d bytes (%d events) from event log (%s) in %.2f seconds" % (size, count, self.__logfile, time_read))
+        log("read %d bytes (%d events) from event log (%s) in %.2f seconds" % (done, count, self.__logfile, time_read))
+        self.__unsaved = count
+        self.__offset, self.__synced = offset + done, time.time()
+
+        if not self.__replica:
+            self.__logs[-1].open()
+            assert offset + done == self.__logs[-1].end()
+
+    def __chunks( self, segments, offset ):
+        """
+            Yield chunks of whole events from given log segments, starting at offset. Headers
+            of segments are yielded as empty chunks, so sizes of chunks add up to size of log.
+            Replica stops before incomplete last record, the primary may be writing it now.
+        """
+        header = len(self.__format.header)
+        for segment in segments:
+            if segment.end() <= offset:
+                continue
+            with open(segment.path, 'rb') as events:
+                start = max(offset - segment.base, 0)
+                if start < header:
+                    yield header - start, b''
+                    start = header
+                events.seek(start)
+                tail = b''
+                while True:
+                    data = events.read(Data.CHUNK)
+                    if not data:
+                        break
+                    data = tail + data
+                    end = self.__format.split(data)
+                    tail = data[end:]
+                    if end > 0:
+                        yield end, data[:end]
+                if tail and not self.__replica:
+                    yield len(tail), tail # incomplete last record, let format decide what to do with it
 
-        self.__log = open(self.__logfile, 'a')
-        assert size == self.__log.tell()
+    def __parse( self, segments, offset, total ):
+        """
+            Read event log by chunks and yield (size of chunk, list of events in it) in order.
+            Big logs are parsed by a pool of processes, number of chunks in flight is limited
+            so memory usage doesn't depend on size of log.
+        """
+        if self.__workers <= 1 or total < Data.PARALLEL:
+            for length, chunk in self.__chunks(segments, offset):
+                yield length, self.__format.decode(chunk)
+            return
+        log("parsing event log with %d processes" % self.__workers)
+        with concurrent.futures.ProcessPoolExecutor(self.__workers) as pool:
+            window = collections.deque()
+            for length, chunk in self.__chunks(segments, offset):
+                window.append((length, pool.submit(eventlog.decode, self.__format.name, chunk)))
+                if len(window) >= 2 * self.__workers:
+                    length, records = window.popleft()
+                    yield length, records.result()
+            while window:
+                length, records = window.popleft()
+                yield length, records.result()
 
-    def __replay( self, line ):
-        data = line.split()
-        timestamp, event = data[0:2]
+    def __fingerprint( self, offset ):
+        md5 = hashlib.md5()
+        start = max(0, offset - Data.FINGERPRINT)
+        for segment in self.__logs:
+            if segment.end() > start and segment.base < offset:
+                md5.update(segment.view(max(start, segment.base) - segment.base, min(offset, segment.end()) - max(start, segment.base)))
+        return md5.digest()
+
+    def __snapshot_valid( self, log_offset, bin_size, fingerprint ):
+        if bin_size > self.__bins[-1].end() or log_offset > self.__logs[-1].end():
+            return False
+        return self.__fingerprint(log_offset) == fingerprint
+
+    def snapshot( self, state ):
+        """
+            Store snapshot of state, which must be the result of replaying whole event log.
+        """
+        start = time.time()
+        self.commit()
+        self.__logs[-1].flush()
+        offset = self.__logs[-1].end()
+        state = {'state': state, 'contents': self.__contents, 'codecs': self.__codecs, 'version': self.__version}
+        size = self.__snapshots.save(state, offset, self.__bins[-1].end(), self.__fingerprint(offset))
+        log("saved snapshot at offset %d (%d bytes) in %.2f seconds" % (offset, size, time.time() - start))
+        self.__unsaved = 0
+
+    def unsaved( self ):
+        """
+            Number of events which are not covered by the latest snapshot.
+        """
+        return self.__unsaved
+
+    def __replay( self, timestamp, event, parameters ):
         if event not in self.replayers:
             log("FATAL: cannot replay event \"%s\" (no such event)" % event)
             sys.exit(1)
-        # log("replay log event: %s" % str(data))
-        data = data[2:]
-        if not isinstance(data, list):
-           data = [data]
-        self.replayers[event](int(timestamp), [None if x == '-' else ''.join(self.__decode(x[1:-1])) for x in data])
+        # log("replay log event: %s %s" % (event, str(parameters)))
+        if event == 'content':
+            hash, name, start, size = parameters[:4]
+            if self.__contents.get(hash, (None, int(start)))[1] != int(start):
+                self.cache.discard(hash) # the same hash for another blob, possible with dedup 'sha256' or 'none'
+            self.__contents[hash] = (name, int(start), int(size))
+            self.__strong.pop(hash, None)
+            if len(parameters) > 4:
+                self.__codecs[hash] = (parameters[4], int(parameters[5]))
+            else:
+                self.__codecs.pop(hash, None)
+        self.replayers[event](timestamp, parameters)
 
     def create( self, event, parameters ):
-        line = [str(int(time.time())), event] + ['-' if x is None else '"' + ''.join(self.__encode(str(x))) + '"' for x in parameters]
-        line = '\t'.join(line)
-        print(line, file=self.__log)
-        self.__log.flush()
-        self.__replay(line)
+        """
+            Add event to the current batch and replay it. Event is written to the log by commit.
+        """
+        assert not self.__replica, "replica cannot create events"
+        record = self.__format.encode(time.time(), event, parameters)
+        self.__pending.append(record)
+        self.__unsaved += 1
+        for timestamp, event, parameters in self.__format.decode(record):
+            self.__replay(timestamp, event, parameters)
+
+    def commit( self ):
+        """
+            Write all events created since last commit with one write, make them as durable
+            as configured and call callbacks which waited for them. Finished compaction is
+            applied here too, between batches.
+        """
+        if self.__pending:
+            start = time.time()
+            self.__bins[-1].flush(self.__durability == 'fsync') # content must not be less durable than events which refer to it
+            if self.__logs[-1].size >= self.__segment_size:
+                self.__rotate_log()
+            batch = b''.join(self.__pending)
+            self.__logs[-1].write(batch)
+            if self.__durability != 'none':
+                self.__logs[-1].flush(self.__durability == 'fsync')
+            duration = time.time() - start
+            stats, count = self.__stats, len(self.__pending)
+            stats['commits'] += 1
+            stats['events'] += count
+            stats['bytes'] += len(batch)
+            stats['batch_last'], stats['batch_max'] = count, max(stats['batch_max'], count)
+            bucket = 1 << (count - 1).bit_length()
+            stats['batches'][bucket] = stats['batches'].get(bucket, 0) + 1
+            stats['time_last'], stats['time_max'] = duration, max(stats['time_max'], duration)
+            stats['time_total'] += duration
+            self.__pending = []
+        waiting, self.__waiting = self.__waiting, []
+        for callback in waiting:
+            callback()
+        if self.__compaction is not None and not self.__compaction['thread'].is_alive():
+            self.__compact_finish()
+
+    def after_commit( self, callback ):
+        """
+            Call callback when all events created so far are committed (immediately if there are none).
+        """
+        if self.__pending:
+            self.__waiting.append(callback)
+        else:
+            callback()
+
+    def stats( self ):
+        """
+            Counters of group commit: number of commits, events and bytes, batch sizes and commit times.
+        """
+        return dict(self.__stats, batches=dict(self.__stats['batches']))
+
+    def segments( self ):
+        """
+            Current layout of storage: generation of manifest and (path, base, size) of segments.
+        """
+        return {
+            'generation': self.__manifest.generation,
+            'compacting': self.compacting(),
+            'log': [(x.path, x.base, x.size) for x in self.__logs],
+            'bin': [(x.path, x.base, x.size) for x in self.__bins]
+        }
+
+    def compacting( self ):
+        """
+            Whether compaction is running (or finished, but not applied yet).
+        """
+        return self.__compaction is not None
+
+    def dropping( self, hash ):
+        """
+            Whether running compaction drops content, so it must not be referenced again.
+        """
+        if self.__compaction is None or hash not in self.__contents:
+            return False
+        return self.__contents[hash][1] < self.__compaction['limit'] and hash not in self.__compaction['keep']
+
+    def follow( self ):
+        """
+            Replica: replay events which the primary appended since the last call and return
+            their number. New segments are taken from manifest. Compaction by the primary
+            changes offsets in the log, so then the whole state is loaded again by start().
+        """
+        assert self.__replica
+        try:
+            manifest = Manifest(self.__logfile, self.__binfile)
+            if manifest.generation != self.__manifest.generation:
+                return self.__reload()
+            for path in manifest.log[len(self.__logs):]:
+                self.__logs.append(Segment(path, 0))
+            for index, segment in enumerate(self.__logs):
+                if index > 0:
+                    segment.base = self.__logs[index - 1].end()
+                if segment.end() >= self.__offset:
+                    segment.size = os.path.getsize(segment.path)
+            count = 0
+            for length, chunk in self.__chunks(self.__logs, self.__offset):
+                records = self.__format.decode(chunk)
+                for timestamp, event, parameters in records:
+                    self.__replay(timestamp, event, parameters)
+                if records:
+                    self.__last_event = records[-1][0]
+                count += len(records)
+                self.__offset += length
+            # content of replayed events is stored before them, so binary storage is checked after log
+            manifest = Manifest(self.__logfile, self.__binfile)
+            known = self.__bins[-1].end()
+            for path, base in manifest.bin[len(self.__bins):]:
+                self.__bins.append(Segment(path, base))
+            for segment in self.__bins:
+                # the last known segment could grow before the primary moved to a new one
+                if segment.end() >= known:
+                    segment.size = os.path.getsize(segment.path)
+        except FileNotFoundError as error:
+            # segments removed by compaction of the primary, new manifest is read by the next call
+            log("WARNING: cannot follow event log: %s" % str(error))
+            return 0
+        self.__manifest = manifest
+        if self.__offset == self.__logs[-1].end():
+            self.__synced = time.time()
+        return count
+
+    def __reload( self ):
+        log("WARNING: storage is compacted by the primary, loading it again")
+        self.__contents, self.__strong, self.__codecs = {}, {}, {}
+        self.cache = Cache(self.cache.budget)
+        self.replayers = self.__replayers
+        self.start(self.__restore)
+        return self.__unsaved
+
+    def replication( self ):
+        """
+            Replica: how far it is behind the primary. Lag is the number of seconds since all
+            events seen in the log were replayed, behind is the number of bytes not replayed yet.
+        """
+        try:
+            end = self.__logs[-1].base + os.path.getsize(self.__logs[-1].path)
+        except FileNotFoundError:
+            end = self.__offset
+        return {
+            'generation': self.__manifest.generation, 'offset': self.__offset, 'behind': max(0, end - self.__offset),
+            'lag': time.time() - self.__synced if end > self.__offset else 0.0, 'last_event': self.__last_event
+        }
+
+    def __rotate_log( self ):
+        self.__logs[-1].flush(True)
+        self.__logs[-1].close()
+        self.__logs.append(Segment(self.__manifest.allocate('log'), self.__logs[-1].end()).open())
+        self.__logs[-1].write(self.__format.header)
+        self.__logs[-1].flush(True)
+        self.__manifest.save(self.__logs, self.__bins)
+
+    def __rotate_bin( self ):
+        self.__bins[-1].flush(True)
+        self.__bins[-1].close()
+        self.__bins.append(Segment(self.__manifest.allocate('bin'), self.__bins[-1].end()).open())
+        self.__manifest.save(self.__logs, self.__bins)
 
     def save( self, content, name=None ):
+        """
+            Store content and return its hash. Content which is already stored is not written
+            again, only its name is updated if it differs.
+        """
         assert isinstance(content, bytes)
         hash = hashlib.md5(content).hexdigest()
         if name is None: name = hash
-        start = self.__bin.tell()
-        size = len(content)
-        self.__bin.write(content)
-        self.__bin.flush()
-        self.create('content', [hash, name, start, size])
+        known = self.__contents.get(hash) if self.__dedup != 'none' else None
+        if known is not None and self.__compaction is not None and known[1] < self.__compaction['limit']:
+            known = None # running compaction may drop it, store a new copy
+        length = self.__codecs[hash][1] if hash in self.__codecs else known[2] if known is not None else None
+        if known is not None and length == len(content) and self.__same(hash, content):
+            if known[0] != name:
+                self.create('content', [hash, name, known[1], known[2]] + self.__codec_parameters(hash))
+            return hash
+        codec, stored = None, content
+        if self.__compression != 'none' and len(content) >= Data.COMPRESS_MIN:
+            compressed = Data.CODECS[self.__compression][0](content)
+            if len(compressed) <= Data.COMPRESS_RATIO * len(content):
+                codec, stored = self.__compression, compressed
+        if self.__bins[-1].size > 0 and self.__bins[-1].size + len(stored) > self.__segment_size:
+            self.__rotate_bin()
+        start = self.__bins[-1].end()
+        self.__bins[-1].write(stored)
+        self.create('content', [hash, name, start, len(stored)] + ([codec, len(content)] if codec is not None else []))
         return hash
 
-    def load( self, start, size ):
+    def __codec_parameters( self, hash ):
+        return list(self.__codecs[hash]) if hash in self.__codecs else []
+
+    def __same( self, hash, content ):
+        if self.__dedup == 'md5':
+            return True
+        if hash not in self.__strong:
+            name, start, size = self.__contents[hash]
+            codec = self.__codecs[hash][0] if hash in self.__codecs else None
+            self.__strong[hash] = hashlib.sha256(self.load(start, size, codec=codec)).digest()
+        if self.__strong[hash] != hashlib.sha256(content).digest():
+            log("WARNING: md5 collision, content %s is stored twice" % hash)
+            return False
+        return True
+
+    def load( self, start, size, hash=None, codec=None ):
+        """
+            Return memoryview of stored bytes. Binary storage is memory-mapped, so raw content
+            is not read or copied here; view stays valid after the storage grows and is remapped.
+            Compressed content (codec is not None) is decompressed. If hash of content is given,
+            decompressed content goes through cache (when it is enabled), so it is decompressed
+            once; raw content is not cached, a copy would cost more than the view of the map.
+        """
         assert isinstance(start, int) and isinstance(size, int)
-        assert size >= 0 and start >= 0 and start + size <= self.__bin.tell()
-        self.__bin.seek(start)
-        r = self.__bin.read(size)
-        self.__bin.seek(0, io.SEEK_END)
-        return r
+        if codec is None:
+            load = lambda: Data.__view(self.__bins, start, size)
+        else:
+            load = lambda: memoryview(Data.CODECS[codec][1](Data.__view(self.__bins, start, size)))
+        if hash is not None and codec is not None and self.cache.budget > 0:
+            return self.cache.get(hash, load)
+        return load()
 
     @staticmethod
-    def __decode( s ):
-        f = False
-        for ch in s:
-            if f:
-                yield chr(ord(ch) - 48)
-                f = False
-            elif ch == '\\':
-                f = True
-            else:
-                yield ch
+    def __view( segments, start, size ):
+        index = bisect.bisect_right([x.base for x in segments], start) - 1
+        assert size >= 0 and index >= 0 and start + size <= segments[index].end()
+        return segments[index].view(start - segments[index].base, size)
 
-    @staticmethod
-    def __encode( s ):
-        for ch in s:
-            if ord(ch) > 32 and ch != '\\' and ch != '"':
-                yield ch
-            else:
-                yield '\\'
-                yield chr(ord(ch) + 48)
+    def compact( self, live, relocate ):
+        """
+            Start compaction of sealed segments: content which is not in live set of hashes is
+            dropped, the rest of content and all other events are copied to new segments by
+            a background thread, while new events go to fresh segments as usual. Finished
+            compaction is applied by commit: new segments replace old ones, then
+            relocate(moved, dropped) is called with new addresses of moved content and set of
+            dropped hashes. Offsets in event log change, so all snapshots are removed.
+            Return False if compaction is already running.
+        """
+        if self.__compaction is not None:
+            return False
+        self.commit()
+        if self.__logs[-1].size > len(self.__format.header):
+            self.__rotate_log()
+        if self.__bins[-1].size > 0:
+            self.__rotate_bin()
+        limit = self.__bins[-1].base # all content below this address is in sealed segments
+        self.__compaction = {
+            'logs': self.__logs[:-1], 'bins': self.__bins[:-1], 'limit': limit, 'relocate': relocate, 'result': None,
+            'keep': {hash: entry for hash, entry in self.__contents.items() if hash in live and entry[1] < limit}
+        }
+        self.__compaction['thread'] = threading.Thread(target=self.__compact, args=(self.__compaction,), daemon=True)
+        self.__compaction['thread'].start()
+        log("compaction started: %d log segments, %d binary segments, %d live blobs" % (
+            len(self.__compaction['logs']), len(self.__compaction['bins']), len(self.__compaction['keep'])
+        ))
+        return True
 
+    def __compact( self, compaction ):
+        """
+            Body of compaction thread. It reads only sealed segments and writes only new ones.
+        """
+        start = time.time()
+        logs, bins, moved, dropped = [], [], {}, 0
+        try:
+            for hash, (name, address, size) in sorted(compaction['keep'].items(), key=lambda x: x[1][1]):
+                if not bins or bins[-1].size > 0 and bins[-1].size + size > self.__segment_size:
+                    bins.append(Segment(self.__manifest.allocate('bin'), bins[-1].end() if bins else 0).open())
+                moved[hash] = bins[-1].end()
+                bins[-1].write(Data.__view(compaction['bins'], address, size))
+            for length, records in self.__parse(compaction['logs'], 0, 0):
+                for timestamp, event, parameters in records:
+                    if event == 'content':
+                        hash, name, address, size = parameters[:4]
+                        if compaction['keep'].get(hash) != (name, int(address), int(size)):
+                            dropped += 1
+                            continue
+                        parameters = [hash, name, moved[hash], size] + list(parameters[4:])
+                    if not logs or logs[-1].size >= self.__segment_size:
+                        logs.append(Segment(self.__manifest.allocate('log'), logs[-1].end() if logs else 0).open())
+                        logs[-1].write(self.__format.header)
+                    logs[-1].write(self.__format.encode(timestamp, event, parameters))
+            for segment in logs + bins:
+                segment.flush(True)
+                segment.close()
+        except Exception as error:
+            log("ERROR: compaction failed: %s" % str(error))
+            for segment in logs + bins:
+                segment.remove()
+            return
+        compaction['result'] = (logs, bins, moved)
+        log("compaction finished in %.2f seconds: %d bytes of live content, %d content events dropped" % (
+            time.time() - start, sum(x.size for x in bins), dropped
+        ))
 
+    def __compact_finish( self ):
+        compaction, self.__compaction = self.__compaction, None
+        if compaction['result'] is None:
+            return
+        logs, bins, moved = compaction['result']
+        if not logs:
+            logs.append(Segment(self.__manifest.allocate('log'), 0).open())
+            logs[-1].write(self.__format.header)
+            logs[-1].flush(True)
+            logs[-1].close()
+        for segment in self.__logs[len(compaction['logs']):]:
+            segment.base = logs[-1].end()
+            logs.append(segment)
+        bins += self.__bins[len(compaction['bins']):]
+        self.__manifest.generation += 1
+        self.__manifest.save(logs, bins)
+        self.__logs, self.__bins = logs, bins
+        # content stored again while compaction was running already has an address above the limit
+        moved = {hash: start for hash, start in moved.items() if self.__contents[hash][1] < compaction['limit']}
+        dropped = {hash for hash, entry in self.__contents.items() if entry[1] < compaction['limit'] and hash not in moved}
+        for hash in dropped:
+            del self.__contents[hash]
+            self.__strong.pop(hash, None)
+            self.__codecs.pop(hash, None)
+            self.cache.discard(hash)
+        for hash, start in moved.items():
+            name, address, size = self.__contents[hash]
+            self.__contents[hash] = (name, start, size)
+        for segment in compaction['logs'] + compaction['bins']:
+            segment.remove()
+        self.__snapshots.clear()
+        log("compaction applied, generation %d: %d blobs moved, %d dropped" % (self.__manifest.generation, len(moved), len(dropped)))
+        compaction['relocate'](moved, dropped)
@@ -0,0 +1,276 @@
+"""
+    Event log formats. Each format turns events (timestamp, event name, list of parameters)
+    into bytes and back. Parameters are strings, numbers or None; the text format returns
+    everything as strings, the binary one keeps numbers typed, replayers accept both.
+"""
+
+import re, struct
+
+class TextFormat:
+    """
+        Original tab-separated format: every event is a line, every parameter is either '-'
+        (None) or a quoted string with whitespace, backslashes and quotes escaped.
+    """
+    name = 'text'
+    header = b''
+
+    def encode( self, timestamp, event, parameters ):
+        line = [str(int(timestamp)), event] + ['-' if x is None else '"' + ''.join(self.__encode(str(x))) + '"' for x in parameters]
+        return ('\t'.join(line) + '\n').encode('utf-8')
+
+    def decode( self, data ):
+        return [self.__parse(line) for line in data.decode('utf-8').splitlines() if line]
+
+    def split( self, data ):
+        """
+            Return length of the longest prefix of data which consists of whole events.
+        """
+        return data.rfind(b'\n') + 1
+
+    def records( self, file ):
+        for line in file:
+            yield self.__parse(line.decode('utf-8'))
+
+    def __parse( self, line ):
+        data = line.split()
+        timestamp, event = data[0:2]
+        return int(timestamp), event, [None if x == '-' else self.__unquote(x) for x in data[2:]]
+
+    @staticmethod
+    def __unquote( x ):
+        x = x[1:-1]
+        return x if '\\' not in x else ''.join(TextFormat.__decode(x))
+
+    @staticmethod
+    def __decode( s ):
+        f = False
+        for ch in s:
+            if f:
+                yield chr(ord(ch) - 48)
+                f = False
+            elif ch == '\\':
+                f = True
+            else:
+                yield ch
+
+    @staticmethod
+    def __encode( s ):
+        for ch in s:
+            if ord(ch) > 32 and ch != '\\' and ch != '"':
+                yield ch
+            else:
+                yield '\\'
+                yield chr(ord(ch) + 48)
+
+class BinaryFormat:
+    """
+        Length-prefixed binary format. File starts with MAGIC, then every event is stored as
+        record header (size of the rest of record, timestamp, event code, size of descriptor),
+        descriptor of parameters (type of each parameter, followed by length for strings) and
+        packed parameters. Event names are coded by their position in EVENTS (0 means that name
+        is stored inline as the first parameter). Parameters listed as numeric in SCHEMA are
+        stored as integers or floats when it is possible without losing their text
+        representation, content hashes are stored as 16 raw bytes, everything else is stored
+        as string. Records with equal descriptors share one precompiled struct, so decoding
+        of a record is a couple of unpack calls.
+    """
+    name = 'binary'
+    MAGIC = b'WOLFLOG\x01'
+    header = MAGIC
+
+    # never reorder, only append: codes are stored in logs
+    EVENTS = [None,
+        'wolf',
+        'archive.add', 'archive.compiler.add', 'archive.compiler.remove', 'archive.remove', 'archive.submit',
+        'compiler.add', 'compiler.modify', 'compiler.remove',
+        'content',
+        'problem.checker.compiled', 'problem.checker.recompile', 'problem.checker.set', 'problem.create',
+        'problem.files.set', 'problem.limits.set', 'problem.modify', 'problem.test.add',
+        'submit', 'submit.compiled', 'submit.test',
+        'team.add', 'team.modify',
+        'problem.parallel.set', 'problem.deterministic.set',
+        'submit.rejudge'
+    ]
+    # numeric parameters of events, by position
+    SCHEMA = {
+        'archive.add': {0},
+        'archive.remove': {0},
+        'archive.submit': {0, 2},
+        'content': {2, 3, 5},
+        'problem.checker.compiled': {0},
+        'problem.checker.recompile': {0},
+        'problem.checker.set': {0},
+        'problem.create': {0},
+        'problem.files.set': {0},
+        'problem.limits.set': {0, 1, 2},
+        'problem.modify': {0},
+        'problem.parallel.set': {0, 1},
+        'problem.deterministic.set': {0, 1},
+        'problem.test.add': {0},
+        'submit': {0, 1},
+        'submit.compiled': {0},
+        'submit.rejudge': {0},
+        'submit.test': {0, 1, 3, 4}
+    }
+    NONE, SHORT, LONG, INT32, INT64, FLOAT, HASH = range(7)
+    HASH_RE = re.compile(r'[0-9a-f]{32}\Z')
+
+    RECORD = struct.Struct('<IIBB') # size of record after size field, timestamp, event code, size of descriptor
+    SIZE = struct.Struct('<I')
+    I32 = struct.Struct('<i')
+    I64 = struct.Struct('<q')
+    F64 = struct.Struct('<d')
+
+    def __init__( self ):
+        self.__codes = {name: code for code, name in enumerate(BinaryFormat.EVENTS) if name is not None}
+        self.__shapes = {}
+
+    def encode( self, timestamp, event, parameters ):
+        code = self.__codes.get(event, 0)
+        numeric = BinaryFormat.SCHEMA.get(event, ())
+        descriptor, body = [], []
+        def add( kind, length, value ):
+            descriptor.append(bytes([kind]) + length)
+            body.append(value)
+        if code == 0:
+            self.__string(add, event)
+        for index, x in enumerate(parameters):
+            if x is None:
+                add(BinaryFormat.NONE, b'', b'')
+            elif index not in numeric or not self.__number(add, x):
+                self.__string(add, str(x))
+        descriptor, body = b''.join(descriptor), b''.join(body)
+        size = BinaryFormat.RECORD.size - BinaryFormat.SIZE.size + len(descriptor) + len(body)
+        return BinaryFormat.RECORD.pack(size, int(timestamp), code, len(descriptor)) + descriptor + body
+
+    @staticmethod
+    def __string( add, s ):
+        if len(s) == 32 and BinaryFormat.HASH_RE.match(s):
+            return add(BinaryFormat.HASH, b'', bytes.fromhex(s))
+        s = s.encode('utf-8')
+        if len(s) < 256:
+            return add(BinaryFormat.SHORT, bytes([len(s)]), s)
+        return add(BinaryFormat.LONG, BinaryFormat.SIZE.pack(len(s)), s)
+
+    @staticmethod
+    def __number( add, x ):
+        if isinstance(x, str):
+            try:
+                if str(int(x)) == x:
+                    x = int(x)
+            except ValueError:
+                try:
+                    if repr(float(x)) == x:
+                        x = float(x)
+                except ValueError:
+                    pass
+        if type(x) is int and -(1 << 31) <= x < (1 << 31):
+            add(BinaryFormat.INT32, b'', BinaryFormat.I32.pack(x))
+        elif type(x) is int and -(1 << 63) <= x < (1 << 63):
+            add(BinaryFormat.INT64, b'', BinaryFormat.I64.pack(x))
+        elif type(x) is float:
+            add(BinaryFormat.FLOAT, b'', BinaryFormat.F64.pack(x))
+        else:
+            return False
+        return True
+
+    def __shape( self, code, descriptor ):
+        """
+            Compile descriptor into struct for parameters and list of conversions for them.
+        """
+        layout, conversions = ['<'], []
+        position = 0
+        while position < len(descriptor):
+            kind = descriptor[position]
+            position += 1
+            if kind == BinaryFormat.SHORT:
+                layout.append('%ds' % descriptor[position])
+                conversions.append((len(layout) - 2, lambda x: x.decode('utf-8')))
+                position += 1
+            elif kind == BinaryFormat.LONG:
+                layout.append('%ds' % BinaryFormat.SIZE.unpack_from(descriptor, position))
+                conversions.append((len(layout) - 2, lambda x: x.decode('utf-8')))
+                position += BinaryFormat.SIZE.size
+            elif kind == BinaryFormat.HASH:
+                layout.append('16s')
+                conversions.append((len(layout) - 2, bytes.hex))
+            elif kind == BinaryFormat.NONE:
+                layout.append('0s')
+                conversions.append((len(layout) - 2, lambda x: None))
+            elif kind in (BinaryFormat.INT32, BinaryFormat.INT64, BinaryFormat.FLOAT):
+                layout.append({BinaryFormat.INT32: 'i', BinaryFormat.INT64: 'q', BinaryFormat.FLOAT: 'd'}[kind])
+            else:
+                raise ValueError("bad parameter type %d in event log" % kind)
+        if code >= len(BinaryFormat.EVENTS):
+            raise ValueError("bad event code %d in event log" % code)
+        if len(self.__shapes) > 65536:
+            self.__shapes.clear()
+        shape = struct.Struct(''.join(layout)), conversions, BinaryFormat.EVENTS[code]
+        self.__shapes[code, descriptor] = shape
+        return shape
+
+    def decode( self, data ):
+        result = []
+        position, size = 0, len(data)
+        header, shapes = BinaryFormat.RECORD, self.__shapes
+        while position < size:
+            length, timestamp, code, count = header.unpack_from(data, position)
+            end = position + 4 + length
+            position += header.size
+            descriptor = bytes(data[position:position + count])
+            position += count
+            shape = shapes.get((code, descriptor))
+            if shape is None:
+                shape = self.__shape(code, descriptor)
+            layout, conversions, event = shape
+            if position + layout.size != end:
+                raise ValueError("bad record size in event log")
+            parameters = list(layout.unpack_from(data, position))
+            for index, convert in conversions:
+                parameters[index] = convert(parameters[index])
+            if event is None:
+                event = parameters.pop(0)
+            result.append((timestamp, event, parameters))
+            position = end
+        return result
+
+    def split( self, data ):
+        """
+            Return length of the longest prefix of data which consists of whole events.
+        """
+        position, size, unpack = 0, len(data), BinaryFormat.SIZE.unpack_from
+        while position + 4 <= size:
+            end = position + 4 + unpack(data, position)[0]
+            if end > size:
+                break
+            position = end
+        return position
+
+    def records( self, file ):
+        while True:
+            head = file.read(BinaryFormat.SIZE.size)
+            if not head:
+                return
+            length, = BinaryFormat.SIZE.unpack(head)
+            data = head + file.read(length)
+            if len(data) != length + BinaryFormat.SIZE.size:
+                raise ValueError("truncated record at the end of event log")
+            yield from self.decode(data)
+
+formats = {x.name: x for x in [TextFormat(), BinaryFormat()]}
+
+def decode( format, data ):
+    """
+        Decode whole events in given format, for use in worker processes.
+    """
+    return formats[format].decode(data)
+
+def detect( header, default ):
+    """
+        Guess format of event log by its first bytes; empty log gets default format.
+    """
+    if header.startswith(BinaryFormat.MAGIC):
+        return formats['binary']
+    if len(header) == 0:
+        return formats[default]
+    return formats['text']
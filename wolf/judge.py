@@ -1,18 +1,68 @@
-import os.path
+import os.path, time
 from .common import log
 from dts.protocol import Packet
 
 class Judge:
+    """
+        Connection to a judge. Judge keeps files by hash and asks for missing ones (FREQ), so
+        hashes of files it holds (which were sent to it or used by it) are remembered. After
+        the first request for missing files judge is known to have a cold cache, then files
+        which it doesn't hold are sent in the first packet, saving a round trip.
+        Every request may have a deadline and a retry action, (function, arguments), which
+        does the same work on another judge. Retry actions of requests which are late or
+        unanswered when judge is shut down are returned to the caller; judge which answers
+        a late request becomes ready again.
+        Judge works on up to slots requests at once: judge may declare its number of slots
+        in authorization packet (Slots), otherwise the default is used. Callback ready is
+        called once for every slot which becomes free.
+    """
     OK, CE, WA, PE, RE, TL, ML, FAIL = range(8)
     status_str = ["OK", "CE", "WA", "PE", "RT", "TL", "ML", "Fail"]
 
-    def __init__( self, socket, callback_ready ):
+    def __init__( self, socket, callback_ready, slots=1 ):
         self.__socket, self.__ready = socket, callback_ready
+        self.slots = slots
         self.__message_id = 0
+        self.__name = None
         self.__response = {None: self.__authorize}
         self.__status = {Judge.status_str[x]: x for x in [Judge.OK, Judge.CE, Judge.WA, Judge.PE, Judge.RE, Judge.TL, Judge.ML, Judge.FAIL]}
+        self.__files = set() # hashes of files which judge holds
+        self.__cold = False # judge asked for missing files at least once
+        self.__stats = {'packets': 0, 'requests': 0, 'files_sent': 0, 'bytes_sent': 0, 'expired': 0}
+        self.__requests = {} # id → (deadline or None, retry action) of requests in progress
+        self.__late = set() # ids of expired requests
+        self.timeouts = 0 # number of expired requests in a row
+        self.__started = self.__changed = time.monotonic()
+        self.__busy = 0.0 # integral of number of requests in progress over time
     def name( self ):
         return self.__name
+    def working( self ):
+        """
+            Whether judge has requests with deadlines in progress.
+        """
+        return any(deadline is not None for deadline, retry in self.__requests.values())
+    def holds( self, hashes ):
+        """
+            Return how many of given hashes judge holds.
+        """
+        return sum(1 for x in hashes if x in self.__files)
+    def stats( self ):
+        """
+            Counters of judge; utilisation is the average fraction of busy slots since connection.
+        """
+        self.__account()
+        elapsed = self.__changed - self.__started
+        return dict(self.__stats,
+            files=len(self.__files), cold=self.__cold, timeouts=self.timeouts,
+            slots=self.slots, working=len(self.__requests),
+            utilisation=self.__busy / (self.slots * elapsed) if elapsed > 0 else 0.0
+        )
+
+    def __account( self ):
+        # called before number of requests changes
+        now = time.monotonic()
+        self.__busy += len(self.__requests) * (now - self.__changed)
+        self.__changed = now
 
     def __authorize( self, packet ):
         del self.__response[None]
@@ -22,17 +72,64 @@ class Judge:
             return []
         # todo: check password
         self.__name = packet[b'Name'].decode('utf8')
-        log("new judge registered in system: %s" % self.__name)
-        return self.__ready(self)
+        if b'Slots' in packet:
+            try:
+                self.slots = max(1, int(packet[b'Slots']))
+            except ValueError:
+                log("WARNING: judge %s declared bad number of slots: %s" % (self.__name, str(packet[b'Slots'])))
+        log("new judge registered in system: %s (%d slots)" % (self.__name, self.slots))
+        result = []
+        for slot in range(self.slots):
+            result.extend(self.__ready(self))
+        return result
+
+    def __request( self, id, response, retry, timeout ):
+        self.__account()
+        self.__response[id] = response
+        self.__requests[id] = (time.monotonic() + timeout if timeout is not None else None, retry)
+
+    def expire( self ):
+        """
+            Drop requests which are past their deadline and return their retry actions.
+        """
+        now = time.monotonic()
+        late = [id for id, (deadline, retry) in self.__requests.items() if deadline is not None and deadline < now]
+        if late:
+            self.__account()
+        for id in late:
+            log("WARNING: judge %s didn't answer request %s in time" % (self.__name, id.decode('ascii')))
+            del self.__response[id]
+            self.__late.add(id)
+            self.timeouts += 1
+            self.__stats['expired'] += 1
+        return [self.__requests.pop(id)[1] for id in late]
 
-    def __normal( self, callback, parameters ):
+    def shutdown( self ):
+        """
+            Disconnect judge and return retry actions of all requests in progress.
+        """
+        self.__response = {}
+        self.__account()
+        retries = [retry for deadline, retry in self.__requests.values()]
+        self.__requests = {}
+        self.__socket.disconnect()
+        return retries
+
+    def __normal( self, callback, parameters, hashes=(), query=None ):
         def response( packet ):
+            self.__account()
             del self.__response[packet[b'ID']]
+            del self.__requests[packet[b'ID']]
+            self.timeouts = 0
             status = packet.get(b'Status').decode('iso8859-1')
             if status == 'FREQ':
                 files = set([x.split('\\')[0] for x in packet[b'FREQ'].decode('utf-8').split('\r\n') if x != ''])
-                self.__query(files)
+                self.__files.difference_update(files)
+                self.__cold = True
+                self.__stats['requests'] += 1
+                query(files)
                 return []
+            self.__files.update(hashes)
             if status not in self.__status:
                 log("ERROR: unknown judge status: %s" % status)
                 log("full packet: %s" % str(packet))
@@ -51,25 +148,31 @@ class Judge:
             (b'ExeFile', None, None),
             (b'UtilityOutput', b'', None)
         ])
-    def __tested( self, callback ):
+    def __tested( self, callback, hashes, query ):
         return self.__normal(callback, [
             (b'MaxTime', '0', lambda x: 1e-7 * int(x)), # testsys judge returns time in 1/10⁷ seconds
             (b'MaxMemory', '0', lambda x: int(x)),
             (b'UtilityOutput', b'', None)
-        ])
+        ], hashes, query)
 
     def receive( self, packet ):
         id = packet.get(b'ID')
+        if id in self.__late:
+            # work is already given to another judge, but this one is free again
+            log("judge %s answered expired request %s" % (self.__name, id.decode('ascii')))
+            self.__late.remove(id)
+            return self.__ready(self)
         if id not in self.__response:
             log("ERROR: unexpected packet from judge: %s" % str(packet))
             return []
         return self.__response[id](packet)
 
-    def compile( self, command, source, binary_name, callback ):
+    def compile( self, command, source, binary_name, callback, retry=None, timeout=None ):
         id = ('id_%08d' % self.__message_id).encode('ascii')
         self.__message_id += 1
-        self.__response[id] = self.__compiled(callback)
-        source_data = ('%s\\%s>%d|\r' % (source.hash, source.name, source.time)).encode('utf-8') + source.load()
+        self.__request(id, self.__compiled(callback), retry, timeout)
+        source_data = (('%s\\%s>%d|\r' % (source.hash, source.name, source.time)).encode('utf-8'), source.load())
+        self.__sent(source_data[1])
         mcn = os.path.splitext(binary_name)[0] # that's so-called 'main class name', ask KOTEHOK (vk.com/kotehok) for its meaning
         self.__socket.send(Packet({
             b'ID': id,
@@ -80,15 +183,22 @@ class Judge:
             # b'BinaryName': binary_name.encode('utf-8') # not supported by judge
         })())
 
-    def test( self, *, binary, run, test, answer, input, output, time_limit, memory_limit, checker, checker_run, callback ):
+    def __sent( self, content ):
+        self.__stats['files_sent'] += 1
+        self.__stats['bytes_sent'] += len(content)
+        return content
+
+    def test( self, *, binary, run, test, answer, input, output, time_limit, memory_limit, checker, checker_run, callback, retry=None, timeout=None ):
+        hashes = [x.hash for x in (binary, test, answer, checker)]
         def query( files ):
             id = ('id_%08d' % self.__message_id).encode('ascii')
             self.__message_id += 1
+            self.__stats['packets'] += 1
             path = lambda f: \
-                    ('%s\\%s>%d|\r' % (f.hash, f.name, f.time)).encode('utf-8') + f.load() \
+                    (('%s\\%s>%d|\r' % (f.hash, f.name, f.time)).encode('utf-8'), self.__sent(f.load())) \
                 if f.hash in files else \
                     ('%s\\%s>%d' % (f.hash, f.name, f.time)).encode('utf-8')
-            self.__response[id] = self.__tested(callback)
+            self.__request(id, self.__tested(callback, hashes, query), retry, timeout)
             mcn = os.path.splitext(binary.name)[0]
             data = {
                 b'ID': id,
@@ -108,6 +218,5 @@ class Judge:
             if checker_run is not None:
                 data[b'CheckerRun'] = checker_run.encode('utf-8')
             self.__socket.send(Packet(data)())
-        self.__query = query
-        query(set())
+        query({x for x in hashes if x not in self.__files} if self.__cold else set())
 
@@ -0,0 +1,71 @@
+import collections, time
+
+class JudgeQueue:
+    """
+        Work which waits for a free judge. Work is split into priority classes (CLASSES,
+        most urgent first), inside a class owners (teams) take turns, so an owner with lots
+        of work doesn't delay others. Waiting work gains priority: every AGING seconds of
+        waiting of the oldest work of a class count as one class up, so nothing starves.
+    """
+    CLASSES = ('checker', 'compile', 'test', 'rejudge', 'archive')
+    AGING = 60.0
+
+    def __init__( self ):
+        # class → owner → deque of (time of push, work), owners are ordered by their turn
+        self.__classes = {name: collections.OrderedDict() for name in JudgeQueue.CLASSES}
+        self.__size = 0
+        self.__stats = {name: {'pushed': 0, 'popped': 0, 'wait_max': 0.0} for name in JudgeQueue.CLASSES}
+
+    def __bool__( self ):
+        return self.__size > 0
+
+    def __len__( self ):
+        return self.__size
+
+    def push( self, work, priority, owner=None ):
+        """
+            Add work of given class (one of CLASSES) on behalf of owner.
+        """
+        owners = self.__classes[priority]
+        if owner not in owners:
+            owners[owner] = collections.deque() # new owner takes the last turn
+        owners[owner].append((time.monotonic(), work))
+        self.__size += 1
+        self.__stats[priority]['pushed'] += 1
+
+    @staticmethod
+    def __oldest( owners ):
+        return min(x[0][0] for x in owners.values())
+
+    def pop( self ):
+        """
+            Remove and return the most urgent work.
+        """
+        assert self.__size > 0
+        now = time.monotonic()
+        rank = lambda x: x[0] - (now - JudgeQueue.__oldest(x[1][1])) / JudgeQueue.AGING
+        index, (priority, owners) = min(((index, x) for index, x in enumerate(self.__classes.items()) if x[1]), key=rank)
+        owner, works = next(iter(owners.items()))
+        pushed, work = works.popleft()
+        if works:
+            owners.move_to_end(owner)
+        else:
+            del owners[owner]
+        self.__size -= 1
+        stats = self.__stats[priority]
+        stats['popped'] += 1
+        stats['wait_max'] = max(stats['wait_max'], now - pushed)
+        return work
+
+    def stats( self ):
+        """
+            Depth of each class, number of its owners and age of its oldest work, with counters.
+        """
+        now = time.monotonic()
+        return {
+            priority: dict(self.__stats[priority],
+                depth=sum(len(x) for x in owners.values()), owners=len(owners),
+                oldest=now - JudgeQueue.__oldest(owners) if owners else None
+            )
+            for priority, owners in self.__classes.items()
+        }
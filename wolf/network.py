@@ -36,6 +36,8 @@ class Poll:
         return socket_handle
 
     def __disconnect( self, socket ):
+        if socket.fileno() == -1:
+            return # already disconnected: EPOLLHUP and empty read both lead here
         self.__poll.unregister(socket)
         del self.__actions[socket.fileno()]
         socket.close()
@@ -61,9 +63,9 @@ class Poll:
             return [(callback, (peer, wrapper, init))]
         return self.__add(socket, action)
 
-    def __call__( self ):
+    def __call__( self, timeout=None ):
         queue = []
-        for handle, events in self.__poll.poll():
+        for handle, events in self.__poll.poll(timeout):
             if handle in self.__actions:
                 queue.append((self.__actions[handle], (handle, events)))
             else:
@@ -0,0 +1,100 @@
+import io, json, mmap, os, threading
+
+class Segment:
+    """
+        One file of segmented storage. Base is the address of its first byte in the address
+        space of the storage. Segment becomes writable (append-only) after open(), sealed
+        segments are never modified. Reads go through memory map, which is remapped when
+        a read goes past its end.
+    """
+    def __init__( self, path, base ):
+        self.path, self.base = path, base
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.__handle = None
+        self.__map = b''
+
+    def end( self ):
+        return self.base + self.size
+
+    def open( self ):
+        self.__handle = open(self.path, 'ab')
+        self.size = self.__handle.tell()
+        return self
+
+    def close( self ):
+        if self.__handle is not None:
+            self.__handle.close()
+            self.__handle = None
+
+    def write( self, data ):
+        self.__handle.write(data)
+        self.size += len(data)
+
+    def flush( self, sync=False ):
+        self.__handle.flush()
+        if sync:
+            os.fsync(self.__handle.fileno())
+
+    def view( self, offset, size ):
+        """
+            Return memoryview of size bytes at offset (relative to the start of segment).
+        """
+        if offset + size > len(self.__map):
+            if self.__handle is not None:
+                self.__handle.flush()
+            # old map is not closed: it is released when the last view into it is gone
+            with open(self.path, 'rb') as f:
+                length = f.seek(0, io.SEEK_END)
+                self.__map = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ) if length > 0 else b''
+        return memoryview(self.__map)[offset:offset + size]
+
+    def remove( self ):
+        self.close()
+        self.__map = b''
+        os.remove(self.path)
+
+class Manifest:
+    """
+        Lists segments of event log and binary storage, stored as JSON next to the log and
+        replaced atomically. Data without manifest consists of a single log file and a single
+        binary file (the original layout); manifest is created on the first rotation.
+        Log segments are concatenated, binary segments keep their base addresses.
+    """
+    def __init__( self, logfile, binfile ):
+        self.path = logfile + '.manifest'
+        self.__logfile, self.__binfile = logfile, binfile
+        self.__directory = os.path.dirname(logfile)
+        self.__lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+            self.generation, self.__next = manifest['generation'], manifest['next']
+            self.log = [os.path.join(self.__directory, x) for x in manifest['log']]
+            self.bin = [(os.path.join(self.__directory, x), base) for x, base in manifest['bin']]
+        else:
+            self.generation, self.__next = 0, 1
+            self.log = [logfile]
+            self.bin = [(binfile, 0)]
+
+    def allocate( self, kind ):
+        """
+            Return name for a new segment of log ('log') or binary storage ('bin').
+        """
+        with self.__lock:
+            number, self.__next = self.__next, self.__next + 1
+        return '%s.%06d' % (self.__logfile if kind == 'log' else self.__binfile, number)
+
+    def save( self, logs, bins ):
+        self.log = [x.path for x in logs]
+        self.bin = [(x.path, x.base) for x in bins]
+        with self.__lock:
+            manifest = {
+                'generation': self.generation, 'next': self.__next,
+                'log': [os.path.relpath(x, self.__directory or '.') for x in self.log],
+                'bin': [(os.path.relpath(x, self.__directory or '.'), base) for x, base in self.bin]
+            }
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
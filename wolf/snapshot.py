@@ -0,0 +1,98 @@
+import hashlib, io, os, pickle, struct
+from .common import log
+
+class Pickler( pickle.Pickler ):
+    def __init__( self, file, externals ):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.__externals = {id(value): key for key, value in externals.items()}
+    def persistent_id( self, obj ):
+        return self.__externals.get(id(obj))
+
+class Unpickler( pickle.Unpickler ):
+    def __init__( self, file, externals ):
+        super().__init__(file)
+        self.__externals = externals
+    def persistent_load( self, key ):
+        if key not in self.__externals:
+            raise pickle.UnpicklingError("unknown external object: %s" % str(key))
+        return self.__externals[key]
+
+class Snapshots:
+    """
+        Checkpoints of replayed state, stored next to event log. Each snapshot remembers
+        offset of event log and size of binary storage it covers, so only the tail of log
+        has to be replayed after loading it, and fingerprint of log bytes before that offset,
+        so it is never applied to a log which was rewritten or converted. Objects which cannot
+        be stored (data storage itself, scheduler callbacks) are passed as externals and are
+        stored by name.
+    """
+    MAGIC = b'WOLFSNAP'
+    HEADER = struct.Struct('<8sQQQ16s16s') # magic, log offset, binary size, payload size, md5 of payload, log fingerprint
+
+    def __init__( self, prefix, externals, keep=2 ):
+        self.__prefix, self.__externals, self.__keep = prefix, externals, keep
+
+    def __path( self, offset ):
+        return '%s.%016x.snapshot' % (self.__prefix, offset)
+
+    def list( self ):
+        """
+            Return list of (offset, path) for all snapshots, newest first.
+        """
+        directory, base = os.path.split(self.__prefix)
+        result = []
+        for name in os.listdir(directory or '.'):
+            if not name.startswith(base + '.') or not name.endswith('.snapshot'):
+                continue
+            try:
+                offset = int(name[len(base) + 1:-len('.snapshot')], 16)
+            except ValueError:
+                continue
+            result.append((offset, os.path.join(directory, name)))
+        return sorted(result, reverse=True)
+
+    def save( self, state, log_offset, bin_size, fingerprint ):
+        path = self.__path(log_offset)
+        payload = io.BytesIO()
+        Pickler(payload, self.__externals).dump(state)
+        payload = payload.getbuffer()
+        size = len(payload)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(Snapshots.HEADER.pack(Snapshots.MAGIC, log_offset, bin_size, size, hashlib.md5(payload).digest(), fingerprint))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        for offset, old in self.list()[self.__keep:]:
+            os.remove(old)
+        return size
+
+    def clear( self ):
+        """
+            Remove all snapshots, used when offsets of event log change.
+        """
+        for offset, path in self.list():
+            os.remove(path)
+
+    def load( self, valid ):
+        """
+            Load newest snapshot which is not corrupted and accepted by valid(log_offset, bin_size, fingerprint).
+            Return (state, log_offset, bin_size) or None if there is no such snapshot.
+        """
+        for offset, path in self.list():
+            try:
+                with open(path, 'rb') as f:
+                    magic, log_offset, bin_size, size, digest, fingerprint = Snapshots.HEADER.unpack(f.read(Snapshots.HEADER.size))
+                    if magic != Snapshots.MAGIC or log_offset != offset:
+                        raise ValueError("bad header")
+                    payload = f.read(size)
+                if len(payload) != size or hashlib.md5(payload).digest() != digest:
+                    raise ValueError("checksum mismatch")
+                if not valid(log_offset, bin_size, fingerprint):
+                    raise ValueError("snapshot doesn't match data files")
+                state = Unpickler(io.BytesIO(payload), self.__externals).load()
+            except Exception as error:
+                log("WARNING: cannot load snapshot %s: %s" % (path, str(error)))
+                continue
+            return state, log_offset, bin_size
+        return None
@@ -0,0 +1,168 @@
+import bisect, collections
+from .treap import Treap
+
+class Cell:
+    """
+        Results of one team on one problem: sorted (time, id) of wrong and of accepted
+        submits, ids order submits made in the same second. Only the first accepted submit
+        and wrong ones before it count, the rest is kept in case results are removed.
+    """
+    __slots__ = ('wrong', 'accepts')
+    def __init__( self ):
+        self.wrong, self.accepts = [], []
+    @property
+    def accepted( self ):
+        return self.accepts[0] if self.accepts else None
+    def attempts( self ):
+        # only attempts made before the accepted one are counted
+        return len(self.wrong) if self.accepted is None else bisect.bisect_left(self.wrong, self.accepted)
+
+class Row:
+    __slots__ = ('team', 'solved', 'penalty', 'cells')
+    def __init__( self, team ):
+        self.team, self.solved, self.penalty, self.cells = team, 0, 0, {}
+    def key( self ):
+        return (-self.solved, self.penalty, self.team)
+
+class Standings:
+    """
+        ACM standings: teams are ordered by number of solved problems, then by penalty time,
+        which is the sum of minutes from start to accepted submission plus PENALTY minutes for
+        each rejected attempt before it, for every solved problem. Start is the start of the
+        contest if it is given, otherwise the first submit of each team (archive has no common
+        start). Rows are kept sorted in a treap, so a result costs O(log n) plus the number of
+        problems the team tried. Every change gets next sequence number, so changes since
+        some moment can be listed.
+    """
+    PENALTY = 20
+    IGNORED = {'CE', 'Fail'} # results which are not counted as attempts
+
+    def __init__( self, start=None ):
+        self.start = start
+        self.sequence = 0
+        self.__rows = {}
+        self.__starts = {} # team → time of its first submit
+        self.__order = Treap() # teams, sorted by Row.key
+        self.__changed = collections.OrderedDict() # team → sequence of its last change, oldest first
+        self.__moves = [] # (sequence, better, worse): rank changed for teams with (solved, penalty) in (better, worse]
+
+    def __key( self, team ):
+        return self.__rows[team].key()
+
+    def add( self, team, problem, time, id, verdict ):
+        """
+            Count final result of submit id made by team at given time.
+        """
+        self.__update(team, problem, time, id, verdict, bisect.insort)
+
+    def remove( self, team, problem, time, id, verdict ):
+        """
+            Forget result which was added before, when submit is rejudged.
+        """
+        self.__update(team, problem, time, id, verdict, lambda results, x: results.remove(x))
+
+    def __update( self, team, problem, time, id, verdict, change ):
+        start = self.__starts.get(team)
+        if start is None or time < start:
+            self.__starts[team] = time
+        row = self.__rows.get(team)
+        if verdict in Standings.IGNORED:
+            if row is not None and self.__starts[team] != start:
+                self.__refresh(row, False)
+            return
+        if row is None:
+            row = self.__rows[team] = Row(team)
+            self.__order.insert(self.__order_position(row.key()), team)
+        if problem not in row.cells:
+            row.cells[problem] = Cell()
+        cell = row.cells[problem]
+        before = (cell.accepted, cell.attempts())
+        change(cell.accepts if verdict == 'AC' else cell.wrong, (time, id))
+        self.__refresh(row, (cell.accepted, cell.attempts()) != before)
+
+    def __refresh( self, row, changed ):
+        """
+            Count solved problems and penalty of row again and move it to its place. Change is
+            recorded if row is changed or it moved.
+        """
+        old = row.key()
+        solved = [cell for cell in row.cells.values() if cell.accepted is not None]
+        row.solved, row.penalty = len(solved), sum(self.__time(row.team, cell) for cell in solved)
+        new = row.key()
+        if new == old and not changed:
+            return
+        self.__order.pop(self.__order.index(row.team))
+        self.__order.insert(self.__order_position(new), row.team)
+        self.sequence += 1
+        self.__changed[row.team] = self.sequence
+        self.__changed.move_to_end(row.team)
+        if new[:2] != old[:2]:
+            # teams between old and new place of this one have their rank changed
+            self.__moves.append((self.sequence, min(old[:2], new[:2]), max(old[:2], new[:2])))
+
+    def __time( self, team, cell ):
+        start = self.start if self.start is not None else self.__starts[team]
+        return max(0, int(cell.accepted[0] - start) // 60) + Standings.PENALTY * cell.attempts()
+
+    def __order_position( self, key ):
+        return self.__order.bisect(key, self.__key)
+
+    def __len__( self ):
+        return len(self.__order)
+
+    def rank( self, team ):
+        """
+            Place of team, teams with equal number of solved problems and penalty share it.
+        """
+        row = self.__rows[team]
+        return self.__order_position((-row.solved, row.penalty)) + 1
+
+    def row( self, team ):
+        """
+            Row of standings as a dict, suitable for JSON.
+        """
+        row = self.__rows[team]
+        return {
+            'rank': self.rank(team), 'team': team, 'solved': row.solved, 'penalty': row.penalty,
+            'problems': [
+                {'problem': problem, 'attempts': cell.attempts(), 'accepted': self.__time(team, cell) - Standings.PENALTY * cell.attempts() if cell.accepted is not None else None}
+                for problem, cell in sorted(row.cells.items())
+            ]
+        }
+
+    def rows( self, start=0, limit=None ):
+        """
+            Rows of the table from given position.
+        """
+        stop = len(self.__order) if limit is None else start + limit
+        return [self.row(team) for team in self.__order[start:stop]]
+
+    def since( self, sequence ):
+        """
+            Rows of teams which changed after given sequence number, oldest change first, then
+            rows of other teams whose rank changed because teams moved, in order of place.
+        """
+        teams = []
+        for team, changed in reversed(self.__changed.items()):
+            if changed <= sequence:
+                break
+            teams.append(team)
+        teams.reverse()
+        # a team keeps its (solved, penalty) unless it changed itself, so ranges of keys still tell which teams are affected
+        ranges = sorted((better, worse) for changed, better, worse in self.__moves[bisect.bisect_right(self.__moves, sequence, key=lambda x: x[0]):])
+        merged = []
+        for better, worse in ranges:
+            if merged and better <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], worse)
+            else:
+                merged.append([better, worse])
+        seen = set(teams)
+        for better, worse in merged:
+            # positions of teams with (solved, penalty) in (better, worse], penalties are integers
+            low = self.__order_position((better[0], better[1] + 1))
+            high = self.__order_position((worse[0], worse[1] + 1))
+            for team in self.__order[low:high]:
+                if team not in seen:
+                    seen.add(team)
+                    teams.append(team)
+        return [self.row(team) for team in teams]
@@ -0,0 +1,177 @@
+import random
+
+class Node:
+    __slots__ = ('value', 'priority', 'size', 'left', 'right', 'parent')
+    def __init__( self, value ):
+        self.value, self.priority, self.size = value, random.random(), 1
+        self.left = self.right = self.parent = None
+
+class Treap:
+    """
+        List of unique hashable values with O(log n) insert and delete by position,
+        access by position and position of value (index), slices cost O(log n + length).
+        It is a treap with implicit keys: nodes are ordered by position and keep sizes
+        of their subtrees; parent links and map value → node make index possible.
+    """
+
+    def __init__( self, values=() ):
+        self.__root = None
+        self.__nodes = {}
+        for value in values:
+            self.append(value)
+
+    def __reduce__( self ):
+        # stored as plain list, tree is rebuilt on load
+        return (Treap, (list(self),))
+
+    @staticmethod
+    def __size( node ):
+        return node.size if node is not None else 0
+
+    @staticmethod
+    def __update( node ):
+        node.size = 1
+        for child in (node.left, node.right):
+            if child is not None:
+                node.size += child.size
+                child.parent = node
+
+    @staticmethod
+    def __merge( left, right ):
+        if left is None or right is None:
+            return left if left is not None else right
+        if left.priority > right.priority:
+            left.right = Treap.__merge(left.right, right)
+            Treap.__update(left)
+            return left
+        right.left = Treap.__merge(left, right.left)
+        Treap.__update(right)
+        return right
+
+    @staticmethod
+    def __split( node, count ):
+        """
+            Split tree into first count nodes and the rest.
+        """
+        if node is None:
+            return None, None
+        if Treap.__size(node.left) >= count:
+            left, node.left = Treap.__split(node.left, count)
+            Treap.__update(node)
+            if left is not None:
+                left.parent = None
+            return left, node
+        node.right, right = Treap.__split(node.right, count - Treap.__size(node.left) - 1)
+        Treap.__update(node)
+        if right is not None:
+            right.parent = None
+        return node, right
+
+    def __node( self, index ):
+        node = self.__root
+        while True:
+            left = Treap.__size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node
+            else:
+                index -= left + 1
+                node = node.right
+
+    def __position( self, index ):
+        if not isinstance(index, int):
+            raise TypeError("list indices must be integers or slices")
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("list index out of range")
+        return index
+
+    def __len__( self ):
+        return Treap.__size(self.__root)
+
+    def __contains__( self, value ):
+        return value in self.__nodes
+
+    def __iter__( self ):
+        stack, node = [], self.__root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.value
+            node = node.right
+
+    def __getitem__( self, index ):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            result = []
+            self.__collect(self.__root, start, stop, result)
+            return result
+        return self.__node(self.__position(index)).value
+
+    def __collect( self, node, start, stop, result ):
+        # append values of subtree at positions [start, stop) to result
+        while node is not None and start < stop:
+            left = Treap.__size(node.left)
+            if start < left:
+                self.__collect(node.left, start, min(stop, left), result)
+            if start <= left < stop:
+                result.append(node.value)
+            node, start, stop = node.right, max(start - left - 1, 0), stop - left - 1
+
+    def __delitem__( self, index ):
+        self.pop(index)
+
+    def insert( self, index, value ):
+        assert value not in self.__nodes
+        index = max(0, min(len(self), index + len(self) if index < 0 else index))
+        node = Node(value)
+        self.__nodes[value] = node
+        left, right = Treap.__split(self.__root, index)
+        self.__root = Treap.__merge(Treap.__merge(left, node), right)
+        self.__root.parent = None
+
+    def append( self, value ):
+        self.insert(len(self), value)
+
+    def pop( self, index=-1 ):
+        index = self.__position(index)
+        left, right = Treap.__split(self.__root, index)
+        node, right = Treap.__split(right, 1)
+        self.__root = Treap.__merge(left, right)
+        if self.__root is not None:
+            self.__root.parent = None
+        del self.__nodes[node.value]
+        return node.value
+
+    def bisect( self, key, order ):
+        """
+            Return number of values v with order(v) < key, values must be sorted by order.
+        """
+        node, index = self.__root, 0
+        while node is not None:
+            if order(node.value) < key:
+                index += Treap.__size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return index
+
+    def index( self, value ):
+        """
+            Return position of value, ValueError if there is no such value.
+        """
+        if value not in self.__nodes:
+            raise ValueError("%s is not in list" % repr(value))
+        node = self.__nodes[value]
+        index = Treap.__size(node.left)
+        while node.parent is not None:
+            if node.parent.right is node:
+                index += Treap.__size(node.parent.left) + 1
+            node = node.parent
+        return index